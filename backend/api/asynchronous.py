@@ -0,0 +1,214 @@
+import asyncio
+from functools import wraps
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers import asgi
+from django.db import close_old_connections
+from django.db.models import prefetch_related_objects
+from foodgramm.middleware import current_timings, instrument_connections
+from rest_framework.generics import get_object_or_404
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.response import Response
+
+from .pagination import FetchedPage
+
+# Parts of a streaming response read from its iterator per thread call.
+STREAM_BATCH = 500
+
+
+def database_sync_to_async(func):
+    """
+    Run func in the shared worker pool rather than in the thread of the
+    request, so that several queries of one request can run at once.
+    Each worker thread has its own connection, closed as after a request.
+    """
+    @wraps(func)
+    def run(*args, **kwargs):
+        close_old_connections()
+        try:
+            with instrument_connections(current_timings.get()):
+                return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(run, thread_sensitive=False)
+
+
+async def stream_in_thread(iterator):
+    """
+    Yield the parts of a blocking iterator joined in batches of
+    STREAM_BATCH, each batch read by a call in the request's thread,
+    whose connection stays open until the response is closed.
+    """
+    def read():
+        return list(islice(iterator, STREAM_BATCH))
+
+    read = sync_to_async(read, thread_sensitive=True)
+    while True:
+        parts = await read()
+        if not parts:
+            return
+        yield b''.join(parts)
+
+
+class ASGIHandler(asgi.ASGIHandler):
+    """
+    Django 3.1 iterates streaming responses on the event loop, where the
+    ORM may not be used. Their content is read from the request's thread
+    instead, a batch at a time, and sent before the closing message.
+    """
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+        content = stream_in_thread(response.streaming_content)
+        response.streaming_content = ()
+
+        async def send_content(message):
+            if message['type'] == 'http.response.body':
+                async for part in content:
+                    for chunk, _ in self.chunk_bytes(part):
+                        await send({'type': 'http.response.body',
+                                    'body': chunk, 'more_body': True})
+            await send(message)
+
+        await super().send_response(response, send_content)
+
+
+class AsyncReadMixin:
+    """
+    Under ASGI (settings.ASYNC_VIEWS) serves the safe methods of a viewset
+    from a coroutine: an action with an <action>_async coroutine runs on
+    the event loop and sends its independent queries to worker threads
+    together, any other action runs in a worker thread. Writes keep the
+    synchronous path in the request's own thread.
+    Listed after CachedResponseMixin, which then caches the responses.
+    """
+
+    @classmethod
+    def as_view(cls, actions=None, **initkwargs):
+        view = super().as_view(actions, **initkwargs)
+        if settings.ASYNC_VIEWS:
+            # dispatch() returns a coroutine, tell Django to await it.
+            view._is_coroutine = asyncio.coroutines._is_coroutine
+        return view
+
+    def dispatch(self, request, *args, **kwargs):
+        if not settings.ASYNC_VIEWS:
+            return super().dispatch(request, *args, **kwargs)
+        if request.method in SAFE_METHODS:
+            return self.async_dispatch(request, *args, **kwargs)
+        return sync_to_async(super().dispatch)(request, *args, **kwargs)
+
+    async def async_dispatch(self, request, *args, **kwargs):
+        """APIView.dispatch() with the blocking steps awaited."""
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+        try:
+            await database_sync_to_async(self.initial)(
+                request, *args, **kwargs)
+            handler = getattr(self, f'{self.action}_async', None)
+            if handler is None:
+                handler = database_sync_to_async(getattr(
+                    self, request.method.lower(),
+                    self.http_method_not_allowed))
+            # Streaming content is read by ASGIHandler.
+            response = await handler(request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+        self.response = self.finalize_response(
+            request, response, *args, **kwargs)
+        return self.response
+
+    async def cached_async(self, request, build):
+        return await build()
+
+    def page_window(self):
+        """
+        Offset and size of the requested ?page=, or None when the page is
+        left to the paginator: no pagination, a cursor or a page given
+        by name.
+        """
+        paginator = self.paginator
+        if not isinstance(paginator, PageNumberPagination):
+            return None
+        keyset = getattr(paginator, 'keyset_class', None)
+        if keyset and keyset.cursor_query_param in self.request.query_params:
+            return None
+        size = paginator.get_page_size(self.request)
+        try:
+            number = int(self.request.query_params.get(
+                paginator.page_query_param, 1))
+        except ValueError:
+            return None
+        if not size or number < 1:
+            return None
+        return (number - 1) * size, size
+
+    async def fetch_page(self, queryset, window):
+        """Count the rows and fetch the page at the same time."""
+        offset, size = window
+        total, rows = await asyncio.gather(
+            database_sync_to_async(queryset.count)(),
+            database_sync_to_async(list)(
+                queryset.prefetch_related(None)[offset:offset + size]))
+        return self.paginate_queryset(FetchedPage(rows, total, offset))
+
+    async def prefetch_async(self, objects, lookups):
+        """Run every prefetch lookup in a thread of its own, together."""
+        if not lookups:
+            # Also the case for the plain rows of lean serializers.
+            return
+        for obj in objects:
+            # Created up front so the threads do not race to create it.
+            if not hasattr(obj, '_prefetched_objects_cache'):
+                obj._prefetched_objects_cache = {}
+        await asyncio.gather(*(
+            database_sync_to_async(prefetch_related_objects)(objects, lookup)
+            for lookup in lookups))
+
+    async def load_related(self, serializer):
+        """
+        Run the lookups of a serializer that loads its own relations,
+        such as LeanRecipeSerializer, together.
+        """
+        if not hasattr(serializer, 'related_queries'):
+            return
+        queries = serializer.related_queries()
+        results = await asyncio.gather(*(
+            database_sync_to_async(query)() for query in queries.values()))
+        serializer.related = dict(zip(queries, results))
+
+    async def list_async(self, request, *args, **kwargs):
+        if self.page_window() is None:
+            return await database_sync_to_async(self.list)(
+                request, *args, **kwargs)
+        return await self.cached_async(request, self.build_list_async)
+
+    async def build_list_async(self):
+        queryset = await database_sync_to_async(self.filter_queryset)(
+            self.get_queryset())
+        page = await self.fetch_page(queryset, self.page_window())
+        await self.prefetch_async(page, queryset._prefetch_related_lookups)
+        serializer = self.get_serializer(page, many=True)
+        await self.load_related(serializer)
+        return self.get_paginated_response(serializer.data)
+
+    async def retrieve_async(self, request, *args, **kwargs):
+        return await self.cached_async(request, self.build_retrieve_async)
+
+    async def build_retrieve_async(self):
+        queryset = await database_sync_to_async(self.filter_queryset)(
+            self.get_queryset())
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        obj = await database_sync_to_async(get_object_or_404)(
+            queryset.prefetch_related(None),
+            **{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        self.check_object_permissions(self.request, obj)
+        await self.prefetch_async([obj], queryset._prefetch_related_lookups)
+        return Response(self.get_serializer(obj).data)
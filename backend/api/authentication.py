@@ -0,0 +1,131 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import router
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from users.models import User
+
+# Shared entries carry their expiry time since the entry format changed.
+SHARED_KEY = 'auth-token:v2:{}'
+
+
+def snapshot(instance):
+    return {field.attname: getattr(instance, field.attname)
+            for field in instance._meta.concrete_fields}
+
+
+def restore(model, values):
+    # Fields added since the snapshot was taken are loaded on access.
+    return model.from_db(router.db_for_read(model), list(values),
+                         list(values.values()))
+
+
+class TokenCache:
+    """
+    Token key -> (user, token) snapshots, kept in a local LRU for
+    TOKEN_CACHE_TTL seconds and, with TOKEN_CACHE_BACKEND, in a cache
+    shared by the workers. Every hit builds fresh instances, so a request
+    never sees what another one did to its user.
+    Signals forget a token on logout and the tokens of a user on any save,
+    which covers password changes and deactivation. Only the shared cache
+    and the local LRU of the saving process are cleared: other workers may
+    keep a stale entry until the TTL runs out. A shared entry keeps the
+    time it expires at and a copy in a local LRU expires with it, so no
+    entry outlives one TTL from the database lookup.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    @property
+    def shared(self):
+        alias = settings.TOKEN_CACHE_BACKEND
+        return caches[alias] if alias else None
+
+    def get(self, key):
+        entry = self._get_local(key)
+        if entry is None and self.shared is not None:
+            entry = self._get_shared(key)
+        if entry is None:
+            return None
+        user, token = restore(User, entry[0]), restore(Token, entry[1])
+        Token.user.field.set_cached_value(token, user)
+        return user, token
+
+    def set(self, key, user, token):
+        entry = (snapshot(user), snapshot(token))
+        self._set_local(key, entry, settings.TOKEN_CACHE_TTL)
+        if self.shared is not None:
+            self.shared.set(
+                SHARED_KEY.format(key),
+                (time.time() + settings.TOKEN_CACHE_TTL, entry),
+                timeout=settings.TOKEN_CACHE_TTL)
+
+    def forget(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.shared is not None:
+            self.shared.delete(SHARED_KEY.format(key))
+
+    def forget_user(self, user_id):
+        for key in Token.objects.filter(user_id=user_id).values_list(
+                'key', flat=True):
+            self.forget(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _get_shared(self, key):
+        shared = self.shared.get(SHARED_KEY.format(key))
+        if shared is None:
+            return None
+        expires, value = shared
+        ttl = expires - time.time()
+        if ttl <= 0:
+            return None
+        self._set_local(key, value, ttl)
+        return value
+
+    def _set_local(self, key, value, ttl):
+        size = settings.TOKEN_CACHE_SIZE
+        if size <= 0 or ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication with the token and user lookup cached."""
+
+    def authenticate_credentials(self, key):
+        cached = token_cache.get(key)
+        if cached is not None:
+            return cached
+        user, token = super().authenticate_credentials(key)
+        # Inactive users and unknown keys raise above and are not kept.
+        token_cache.set(key, user, token)
+        return user, token
@@ -0,0 +1,69 @@
+import hashlib
+import json
+import threading
+from bisect import bisect_left
+
+from recipes.models import Ingredient
+
+from .cache import get_version
+
+
+def fold(value):
+    return value.casefold().replace('ё', 'е')
+
+
+def render(rows):
+    return b'[' + b','.join(rows) + b']'
+
+
+class IngredientIndex:
+    """
+    In-process prefix index over ingredient names.
+    Built lazily once per worker and rebuilt when the shared ingredients
+    version, bumped by signals on every save or delete, moves on.
+    Rows are kept pre-serialised, so a response is just a slice of the
+    sorted list joined into bytes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def _build(self, version):
+        entries = sorted(
+            (fold(name), json.dumps(
+                {'id': pk, 'name': name, 'measurement_unit': unit},
+                ensure_ascii=False, separators=(',', ':')).encode())
+            for pk, name, unit in Ingredient.objects.values_list(
+                'id', 'name', 'measurement_unit'))
+        keys = [key for key, _ in entries]
+        rows = [row for _, row in entries]
+        body = render(rows)
+        return version, keys, rows, body, hashlib.md5(body).hexdigest()
+
+    def _get_snapshot(self):
+        version = get_version('ingredients')
+        snapshot = self._snapshot
+        if snapshot is None or snapshot[0] != version:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None or snapshot[0] != version:
+                    snapshot = self._snapshot = self._build(version)
+        return snapshot
+
+    def search(self, prefix='', limit=None):
+        """Return the JSON body and its ETag for a name prefix."""
+        _, keys, rows, body, etag = self._get_snapshot()
+        prefix = fold(prefix)
+        if not prefix:
+            return body, etag
+        start = bisect_left(keys, prefix)
+        end = bisect_left(
+            keys, prefix[:-1] + chr(ord(prefix[-1]) + 1), lo=start)
+        if limit is not None:
+            end = min(end, start + limit)
+        found = render(rows[start:end])
+        return found, hashlib.md5(found).hexdigest()
+
+
+ingredient_index = IngredientIndex()
@@ -0,0 +1,121 @@
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework import status
+from rest_framework.response import Response
+
+from .asynchronous import database_sync_to_async
+
+VERSION_KEY = 'version:{}'
+
+
+def get_version(namespace):
+    key = VERSION_KEY.format(namespace)
+    version = cache.get(key)
+    if version is None:
+        # A fresh starting point keeps entries written under a version
+        # that has since been evicted from ever matching again.
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def advance(namespace):
+    """Bump a single namespace and return its new version."""
+    key = VERSION_KEY.format(namespace)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        version = time.time_ns()
+        cache.set(key, version, timeout=None)
+        return version
+
+
+def bump(*namespaces):
+    """
+    Bump the namespaces now and once more when the current transaction
+    commits. A reader that still sees the old rows in between may cache
+    its response under the first new version; the second one retires it.
+    Outside a transaction both happen at once.
+    """
+    def advance_all():
+        for namespace in namespaces:
+            advance(namespace)
+
+    advance_all()
+    transaction.on_commit(advance_all)
+
+
+def user_namespace(user_id):
+    return f'user:{user_id}'
+
+
+class CachedResponseMixin:
+    """
+    Caches list and retrieve responses under keys that embed the current
+    version of every namespace in cache_namespaces, so bumping a version
+    from a signal retires all dependent entries without a scan.
+    With cache_per_user the key also carries the user and that user's own
+    namespace, for responses with per-user flags. Clients sending the last
+    ETag in If-None-Match get 304 Not Modified.
+    """
+    cache_namespaces = ()
+    cache_per_user = False
+    cached_actions = ('list', 'retrieve')
+
+    def response_cache_key(self, request):
+        parts = [request.get_full_path()]
+        parts += [str(get_version(namespace))
+                  for namespace in self.cache_namespaces]
+        if self.cache_per_user and request.user.is_authenticated:
+            parts += [str(request.user.id),
+                      str(get_version(user_namespace(request.user.id)))]
+        return 'response:' + hashlib.md5(
+            '|'.join(parts).encode()).hexdigest()
+
+    def cache_lookup(self, request):
+        """The key, the ETag and the cached response if there is one."""
+        key = self.response_cache_key(request)
+        etag = f'"{key[len("response:"):]}"'
+        if etag in request.headers.get('If-None-Match', ''):
+            return key, etag, Response(status=status.HTTP_304_NOT_MODIFIED)
+        data = cache.get(key)
+        return key, etag, None if data is None else Response(data)
+
+    def cached(self, request, build):
+        if self.action not in self.cached_actions:
+            return build()
+        key, etag, response = self.cache_lookup(request)
+        if response is None:
+            response = build()
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            cache.set(key, response.data)
+        response['ETag'] = etag
+        return response
+
+    async def cached_async(self, request, build):
+        """cached() for coroutine handlers; the cache is used from a thread."""
+        if self.action not in self.cached_actions:
+            return await build()
+        key, etag, response = await database_sync_to_async(
+            self.cache_lookup)(request)
+        if response is None:
+            response = await build()
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            await database_sync_to_async(cache.set)(key, response.data)
+        response['ETag'] = etag
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached(
+            request, lambda: super(CachedResponseMixin, self).list(
+                request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached(
+            request, lambda: super(CachedResponseMixin, self).retrieve(
+                request, *args, **kwargs))
@@ -0,0 +1,78 @@
+from recipes.models import Recipe
+from recipes.search import chunks
+
+from .renderers import FastJSONRenderer, RawJSON
+from .serializers import (LeanRecipeSerializer, absolute_url,
+                          image_variant_urls, recipe_authors,
+                          recipe_ingredients, recipe_tags)
+
+# Stands for the is_subscribed of the author in a stored card. JSON never
+# holds a raw control character, escaped or not, so it cannot clash.
+SUBSCRIBED = '\x1f'
+BOOLEANS = {True: b'true', False: b'false'}
+
+render = FastJSONRenderer().render
+
+
+def card_text(recipe_id, name, text, author, tags, ingredients):
+    """
+    The JSON of RecipeSerializer from "id" to "text", without the closing
+    brace: the fields up to the image, which change only with the recipe,
+    its author, tags and ingredients, and the author flag as SUBSCRIBED.
+    """
+    author = {key: value for key, value in author.items()
+              if key != 'is_subscribed'}
+    return b''.join((
+        render({'id': recipe_id, 'tags': tags})[:-1],
+        b',"author":', render(author)[:-1],
+        b',"is_subscribed":', SUBSCRIBED.encode(), b'}',
+        b',', render({'ingredients': ingredients, 'name': name,
+                      'text': text})[1:-1],
+    )).decode()
+
+
+def refresh_cards(recipe_ids):
+    """Rebuild the stored cards of the given recipes."""
+    for chunk in chunks(recipe_ids):
+        recipes = list(Recipe.objects.filter(id__in=chunk).only(
+            'id', 'author_id', 'name', 'text'))
+        authors = recipe_authors(
+            {recipe.author_id for recipe in recipes}, None)
+        tags = recipe_tags(chunk)
+        ingredients = recipe_ingredients(chunk)
+        for recipe in recipes:
+            recipe.card = card_text(
+                recipe.id, recipe.name, recipe.text,
+                authors[recipe.author_id], tags.get(recipe.id, []),
+                ingredients.get(recipe.id, []))
+        Recipe.objects.bulk_update(recipes, ['card'])
+
+
+class CardRecipeSerializer(LeanRecipeSerializer):
+    """
+    LeanRecipeSerializer for rows that also carry the stored card and
+    is_subscribed. A recipe with a card is rendered as RawJSON: the card
+    with the author flag put in, followed by the image, cooking time and
+    the flags of the user. Only the rows without a card need the related
+    lookups. Checked against RecipeSerializer by SerializerContractTest.
+    """
+
+    def built_rows(self):
+        return [row for row in self.instance if not row['card']]
+
+    def to_representation(self, row):
+        if not row['card']:
+            return super().to_representation(row)
+        request = self.context.get('request')
+        head, tail = row['card'].encode().split(SUBSCRIBED.encode())
+        rest = render({
+            'image': (absolute_url(row['image'], request)
+                      if row['image'] else None),
+            'image_variants': image_variant_urls(row['image_variants'],
+                                                 request),
+            'cooking_time': row['cooking_time'],
+            'is_favorited': row['is_favorited'],
+            'is_in_shopping_cart': row['is_in_shopping_cart'],
+        })
+        return RawJSON(b''.join((head, BOOLEANS[row['is_subscribed']],
+                                 tail, b',', rest[1:])))
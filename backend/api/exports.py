@@ -0,0 +1,47 @@
+import csv
+import json
+
+SHOPPING_LIST_TITLE = 'Список покупок:'
+
+
+class Echo:
+    """A file-like object that hands back what is written to it."""
+
+    def write(self, value):
+        return value
+
+
+def shopping_list_txt(ingredients):
+    yield f'{SHOPPING_LIST_TITLE}\n\n'
+    for ingredient in ingredients:
+        yield (f'{ingredient["ingredient__name"]}: '
+               f'{ingredient["total"]} '
+               f'{ingredient["ingredient__measurement_unit"]}\n')
+
+
+def shopping_list_csv(ingredients):
+    writer = csv.writer(Echo())
+    yield writer.writerow(('name', 'amount', 'measurement_unit'))
+    for ingredient in ingredients:
+        yield writer.writerow((ingredient['ingredient__name'],
+                               ingredient['total'],
+                               ingredient['ingredient__measurement_unit']))
+
+
+def shopping_list_json(ingredients):
+    separator = '['
+    for ingredient in ingredients:
+        yield separator + json.dumps(
+            {'name': ingredient['ingredient__name'],
+             'amount': ingredient['total'],
+             'measurement_unit': ingredient['ingredient__measurement_unit']},
+            ensure_ascii=False)
+        separator = ','
+    yield '[]' if separator == '[' else ']'
+
+
+SHOPPING_LIST_FORMATS = {
+    'txt': ('text/plain; charset=utf-8', shopping_list_txt),
+    'csv': ('text/csv; charset=utf-8', shopping_list_csv),
+    'json': ('application/json', shopping_list_json),
+}
@@ -1,20 +1,35 @@
 import base64
-import imghdr
+import binascii
+import tempfile
 import uuid
 
-from django.core.files.base import ContentFile
-from rest_framework.serializers import ImageField
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from PIL import Image
+from rest_framework.serializers import ImageField, IntegerField, ListField
+
+# A multiple of 4, so every chunk decodes on its own.
+BASE64_CHUNK = 64 * 1024
 
 
 class Base64ImageField(ImageField):
     """
     A Django REST framework field for handling image-uploads through raw post
-    data.
+    data or a multipart file part.
     It uses base64 for encoding and decoding the contents of the file.
     Heavily based on
     https://github.com/tomchristie/django-rest-framework/pull/1268
     Updated for Django REST framework 3.
+    The payload is decoded chunk by chunk into a spooled file that spills
+    to disk past FILE_UPLOAD_MAX_MEMORY_SIZE, like Django does for
+    multipart uploads. Either way the file is validated with Pillow,
+    rejected when a side exceeds IMAGE_MAX_DIMENSION and renamed after
+    the format it actually has.
     """
+    default_error_messages = {
+        'too_large': ('Изображение больше {max_dimension} пикселей '
+                      'по одной из сторон.'),
+    }
 
     def to_internal_value(self, data):
         # Check if this is a base64 string
@@ -26,24 +41,59 @@ class Base64ImageField(ImageField):
 
             # Try to decode the file. Return validation error if it fails.
             try:
-                decoded_file = base64.b64decode(data)
-            except TypeError:
+                data = self.decode(data)
+            except (binascii.Error, ValueError):
                 self.fail('invalid_image')
 
+        if hasattr(data, 'read'):
+            try:
+                extension = self.get_file_extension(data)
+            except (OSError, ValueError, Image.DecompressionBombError):
+                self.fail('invalid_image')
             # Generate file name:
             # 12 characters are more than enough.
             file_name = str(uuid.uuid4())[:12]
-            # Get the file name extension:
-            file_extension = self.get_file_extension(file_name, decoded_file)
+            data.name = '%s.%s' % (file_name, extension)
+
+        image_file = super().to_internal_value(data)
+        self.validate_dimensions(image_file)
+        return image_file
 
-            complete_file_name = "%s.%s" % (file_name, file_extension, )
+    def decode(self, data):
+        # Encoders commonly wrap lines, which validate=True refuses.
+        data = ''.join(data.split())
+        size = len(data) * 3 // 4 - data[-2:].count('=')
+        # Spills to disk once past FILE_UPLOAD_MAX_MEMORY_SIZE.
+        spool = tempfile.SpooledTemporaryFile(
+            max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+        upload = UploadedFile(spool, 'image', None, size)
+        for start in range(0, len(data), BASE64_CHUNK):
+            upload.write(base64.b64decode(
+                data[start:start + BASE64_CHUNK], validate=True))
+        upload.seek(0)
+        return upload
 
-            data = ContentFile(decoded_file, name=complete_file_name)
+    def validate_dimensions(self, image_file):
+        width, height = image_file.image.size
+        if max(width, height) > settings.IMAGE_MAX_DIMENSION:
+            self.fail('too_large',
+                      max_dimension=settings.IMAGE_MAX_DIMENSION)
 
-        return super(Base64ImageField, self).to_internal_value(data)
+    def get_file_extension(self, decoded_file):
+        # Only the header is read here, the full check is left to Pillow
+        # in ImageField.
+        extension = Image.open(decoded_file).format.lower()
+        decoded_file.seek(0)
+        return "jpg" if extension == "jpeg" else extension
 
-    def get_file_extension(self, file_name, decoded_file):
 
-        extension = imghdr.what(file_name, decoded_file)
+class PrimaryKeyListField(ListField):
+    """
+    Takes a plain list of ids and renders the primary keys of a related
+    manager. Unlike PrimaryKeyRelatedField(many=True) it does not query
+    the database per item: the serializer resolves the ids in one go.
+    """
+    child = IntegerField(min_value=1)
 
-        return "jpg" if extension == "jpeg" else extension
+    def to_representation(self, data):
+        return [item.pk for item in data.all()]
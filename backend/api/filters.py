@@ -1,26 +1,40 @@
-from django_filters import BooleanFilter, FilterSet, ModelMultipleChoiceFilter
+from django_filters import (CharFilter, ChoiceFilter, FilterSet,
+                            ModelMultipleChoiceFilter)
 from recipes.models import Recipe, Tag
+from recipes.search import search_recipes
+
+# The frontend sends 1/0, the browsable API true/false.
+TRUE_VALUES = ('1', 'true')
 
 
 class FilterRecipe(FilterSet):
-    is_favorited = BooleanFilter(method='favorited')
-    is_in_shopping_cart = BooleanFilter(method='in_shopping_cart')
+    is_favorited = CharFilter(method='favorited')
+    is_in_shopping_cart = CharFilter(method='in_shopping_cart')
     tags = ModelMultipleChoiceFilter(field_name='tags__slug',
                                      to_field_name='slug',
                                      queryset=Tag.objects.all())
+    search = CharFilter(method='ranked_search')
+    ordering = ChoiceFilter(choices=(('popular', 'Популярные'),),
+                            method='order')
 
     class Meta:
         model = Recipe
-        fields = ('author', 'tags', 'is_favorited', 'is_in_shopping_cart')
+        fields = ('author', 'tags', 'is_favorited', 'is_in_shopping_cart',
+                  'search', 'ordering')
 
-    def favorit(self, queryset, name, value):
-        user = self.request.user
-        if not value:
+    def favorited(self, queryset, name, value):
+        if value.lower() not in TRUE_VALUES:
             return queryset
-        return queryset.filter(favorites__user=user)
+        return queryset.filter(is_favorited=True)
 
-    def shoping_cart(self, queryset, name, value):
-        user = self.request.user
-        if not value:
+    def in_shopping_cart(self, queryset, name, value):
+        if value.lower() not in TRUE_VALUES:
             return queryset
-        return queryset.filter(shopping_cart__user=user)
+        return queryset.filter(is_in_shopping_cart=True)
+
+    def ranked_search(self, queryset, name, value):
+        return search_recipes(queryset, value).order_by('-search_rank', '-id')
+
+    def order(self, queryset, name, value):
+        # Scores are precomputed by the rank_recipes command.
+        return queryset.order_by('-popularity', '-id')
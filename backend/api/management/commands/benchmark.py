@@ -0,0 +1,372 @@
+import base64
+import io
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import django
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from PIL import Image
+from recipes.loadtest import seed_recipes, seed_relations, seed_users
+from recipes.models import Ingredient, Recipe, ShoppingCart, Tag
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+# 1x1 transparent PNG.
+IMAGE = ('data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJ'
+         'AAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==')
+
+
+def photo(width=3000, height=2000):
+    """A camera-sized JPEG; noise keeps it from compressing."""
+    buffer = io.BytesIO()
+    Image.effect_noise((width, height), 40).convert('RGB').save(
+        buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(path) for name in files)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Command(BaseCommand):
+    help = ('Заполняет базу синтетическими данными, прогоняет основные '
+            'эндпоинты API и сравнивает результат с сохранённым замером')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--recipes', type=int, default=2000)
+        parser.add_argument('--favorites', type=int, default=20,
+                            help='Избранных рецептов на пользователя')
+        parser.add_argument('--carts', type=int, default=10,
+                            help='Рецептов в корзине на пользователя')
+        parser.add_argument('--follows', type=int, default=10,
+                            help='Подписок на пользователя')
+        parser.add_argument('--big-cart', type=int, default=2000,
+                            help='Рецептов в корзине покупателя, чей '
+                                 'список выгружают сценарии shopping_list_big')
+        parser.add_argument('--requests', type=int, default=50,
+                            help='Запросов на каждый сценарий')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--scenario', action='append', default=[],
+                            help='Запустить только указанные сценарии')
+        parser.add_argument('--output', help='Сохранить результат в JSON')
+        parser.add_argument('--baseline', help='JSON прошлого запуска')
+        parser.add_argument(
+            '--fail-above', type=float,
+            help='Ошибка, если p95 вырос больше чем на столько процентов')
+        parser.add_argument('--keep', action='store_true',
+                            help='Не откатывать созданные данные')
+
+    def handle(self, *args, **options):
+        if not Ingredient.objects.exists():
+            raise CommandError('Сначала загрузите ингредиенты: load_data')
+        names = options['scenario'] or [
+            name[len('scenario_'):] for name in dir(self)
+            if name.startswith('scenario_')]
+        unknown = [name for name in names
+                   if not hasattr(self, f'scenario_{name}')]
+        if unknown:
+            raise CommandError(f'Неизвестные сценарии: {unknown}')
+
+        self.rnd = random.Random(options['seed'])
+        self.photo = None
+        with tempfile.TemporaryDirectory() as media_root:
+            self.media_root = media_root
+            # Image variants are rendered inline, outside the timed part.
+            # The scenarios repeat uploads and exports far beyond the
+            # throttle rates.
+            with override_settings(DEBUG=False, MEDIA_ROOT=media_root,
+                                   IMAGE_WORKERS=0, REST_FRAMEWORK={
+                                       **settings.REST_FRAMEWORK,
+                                       'DEFAULT_THROTTLE_RATES': {}}):
+                results = self.measure(names, options)
+
+        report = {
+            'meta': {
+                'vendor': connection.vendor,
+                'django': django.get_version(),
+                **{key: options[key] for key in (
+                    'users', 'recipes', 'favorites', 'carts', 'follows',
+                    'big_cart', 'requests', 'seed')},
+            },
+            'results': results,
+        }
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as f:
+                baseline = json.load(f)['results']
+        regressions = self.print_report(results, baseline,
+                                        options['fail_above'])
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        if regressions:
+            raise CommandError(f'Регрессия p95: {", ".join(regressions)}')
+
+    @transaction.atomic
+    def measure(self, names, options):
+        self.seed(options)
+        results = {name: self.run(name, options['requests'])
+                   for name in sorted(names)}
+        transaction.set_rollback(not options['keep'])
+        return results
+
+    def seed(self, options):
+        started = time.perf_counter()
+        self.user_ids = seed_users(options['users'])
+        self.recipe_ids = seed_recipes(self.user_ids, options['recipes'],
+                                       rnd=self.rnd)
+        seed_relations(self.user_ids, self.recipe_ids,
+                       options['favorites'], options['carts'],
+                       options['follows'], rnd=self.rnd)
+        # One buyer with most of the recipes in the cart: the export has
+        # to stay flat in memory however long the list gets.
+        self.big_buyer = seed_users(1)[0]
+        seed_relations([self.big_buyer], self.recipe_ids,
+                       carts=options['big_cart'], rnd=self.rnd)
+        call_command('recount', stdout=io.StringIO())
+        call_command('rank_recipes', stdout=io.StringIO())
+        call_command('refresh_cards', stdout=io.StringIO())
+        self.recipe_authors = dict(
+            Recipe.objects.values_list('id', 'author_id'))
+        self.carts = set(ShoppingCart.objects.values_list(
+            'user_id', 'recipes_id'))
+        self.tag_ids = list(Tag.objects.values_list('id', flat=True))
+        self.tag_slugs = list(Tag.objects.values_list('slug', flat=True))
+        self.ingredient_ids = list(
+            Ingredient.objects.values_list('id', flat=True))
+        self.ingredient_names = list(
+            Ingredient.objects.values_list('name', flat=True))
+        self.clients = {}
+        self.stdout.write(f'Данные созданы за '
+                          f'{time.perf_counter() - started:.1f} с')
+
+    def client(self, user_id):
+        if user_id not in self.clients:
+            token, _ = Token.objects.get_or_create(user_id=user_id)
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+            self.clients[user_id] = client
+        return self.clients[user_id]
+
+    def request(self, name):
+        user_id, method, path, data = getattr(self, f'scenario_{name}')()
+        client = self.client(user_id) if user_id else APIClient()
+        multipart = data and any(
+            isinstance(value, SimpleUploadedFile) for value in data.values())
+        response = getattr(client, method)(
+            path, data, format='multipart' if multipart else 'json')
+        if response.streaming:
+            for _ in response.streaming_content:
+                pass
+        return response.status_code
+
+    def run_on_commit(self):
+        # Everything runs inside one transaction that is rolled back, so
+        # on_commit callbacks would never fire. Run them by hand, as the
+        # commit after a real request would.
+        callbacks, connection.run_on_commit = connection.run_on_commit, []
+        for _, callback in callbacks:
+            callback()
+
+    def run(self, name, requests):
+        self.request(name)
+        self.run_on_commit()
+        stored = directory_size(self.media_root)
+        timings, queries, statuses = [], [], {}
+        for _ in range(requests):
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                status = self.request(name)
+                timings.append((time.perf_counter() - started) * 1000)
+            queries.append(len(captured))
+            statuses[status] = statuses.get(status, 0) + 1
+            self.run_on_commit()
+        stored = directory_size(self.media_root) - stored
+        tracemalloc.start()
+        self.request(name)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.run_on_commit()
+        return {
+            'p50_ms': round(percentile(timings, 0.5), 3),
+            'p95_ms': round(percentile(timings, 0.95), 3),
+            'queries': max(queries),
+            'peak_kib': round(peak / 1024, 1),
+            'stored_kib': round(stored / requests / 1024, 1),
+            'statuses': {str(key): value for key, value in statuses.items()},
+        }
+
+    def print_report(self, results, baseline, fail_above):
+        regressions = []
+        self.stdout.write(f'{"сценарий":<24}{"p50, мс":>10}{"p95, мс":>10}'
+                          f'{"запросы":>9}{"пик, КиБ":>10}'
+                          f'{"файлы, КиБ":>12}{"Δp95":>9}')
+        for name, result in results.items():
+            delta = ''
+            previous = (baseline or {}).get(name)
+            if previous and previous['p95_ms']:
+                change = (result['p95_ms'] / previous['p95_ms'] - 1) * 100
+                delta = f'{change:+.0f}%'
+                if fail_above is not None and change > fail_above:
+                    regressions.append(name)
+            self.stdout.write(
+                f'{name:<24}{result["p50_ms"]:>10.2f}'
+                f'{result["p95_ms"]:>10.2f}{result["queries"]:>9}'
+                f'{result["peak_kib"]:>10.1f}'
+                f'{result.get("stored_kib", 0):>12.1f}{delta:>9}')
+        return regressions
+
+    def any_user(self):
+        return self.rnd.choice(self.user_ids)
+
+    def scenario_recipe_list(self):
+        return None, 'get', '/api/recipes/?page=1&limit=6', None
+
+    def scenario_recipe_list_large(self):
+        """A long page, where serialising dominates over SQL."""
+        return (self.any_user(), 'get', '/api/recipes/?page=1&limit=50',
+                None)
+
+    def scenario_recipe_list_filtered(self):
+        page = self.rnd.randint(1, 3)
+        return (self.any_user(), 'get',
+                f'/api/recipes/?page={page}&limit=6&is_favorited=true'
+                f'&tags={self.rnd.choice(self.tag_slugs)}', None)
+
+    def scenario_recipe_list_popular(self):
+        return (self.any_user(), 'get',
+                '/api/recipes/?page=1&limit=6&ordering=popular', None)
+
+    def scenario_recipe_similar(self):
+        return (self.any_user(), 'get',
+                f'/api/recipes/{self.rnd.choice(self.recipe_ids)}/similar/',
+                None)
+
+    def scenario_recipe_detail(self):
+        return (self.any_user(), 'get',
+                f'/api/recipes/{self.rnd.choice(self.recipe_ids)}/', None)
+
+    def scenario_user_me(self):
+        """
+        Little beyond authentication itself, for a few users coming back
+        as active clients do.
+        """
+        return (self.rnd.choice(self.user_ids[:10]), 'get', '/api/users/me/',
+                None)
+
+    def scenario_subscriptions(self):
+        return (self.any_user(), 'get',
+                '/api/users/subscriptions/?page=1&limit=6&recipes_limit=3',
+                None)
+
+    def scenario_subscription_feed(self):
+        return (self.any_user(), 'get', '/api/recipes/feed/?limit=6', None)
+
+    def scenario_recipe_search(self):
+        word = self.rnd.choice(self.ingredient_names).split()[0][:5]
+        return (self.any_user(), 'get',
+                f'/api/recipes/?page=1&limit=6&search={word}', None)
+
+    def scenario_pantry(self):
+        ingredients = ','.join(
+            str(pk) for pk in self.rnd.sample(self.ingredient_ids, 10))
+        return (None, 'get',
+                f'/api/recipes/pantry/?ingredients={ingredients}', None)
+
+    def scenario_ingredient_search(self):
+        prefix = self.rnd.choice(self.ingredient_names)[:2]
+        return None, 'get', f'/api/ingredients/?name={prefix}', None
+
+    def scenario_shopping_list(self):
+        return (self.any_user(), 'get',
+                '/api/recipes/download_shopping_cart/', None)
+
+    def big_shopping_list(self, export_format):
+        return (self.big_buyer, 'get', f'/api/recipes/download_shopping_cart/'
+                f'?format={export_format}', None)
+
+    def scenario_shopping_list_big_txt(self):
+        return self.big_shopping_list('txt')
+
+    def scenario_shopping_list_big_csv(self):
+        return self.big_shopping_list('csv')
+
+    def scenario_shopping_list_big_json(self):
+        return self.big_shopping_list('json')
+
+    def scenario_shopping_cart_add(self):
+        # The single endpoint fails on a recipe already in the cart.
+        while True:
+            user_id = self.any_user()
+            recipe_id = self.rnd.choice(self.recipe_ids)
+            if (user_id, recipe_id) not in self.carts:
+                break
+        self.carts.add((user_id, recipe_id))
+        return (user_id, 'post', f'/api/recipes/{recipe_id}/shopping_cart/',
+                None)
+
+    def scenario_shopping_cart_bulk(self):
+        """A meal plan of 20 recipes in one request."""
+        return (self.any_user(), 'post', '/api/recipes/shopping_cart/',
+                {'ids': self.rnd.sample(self.recipe_ids, 20)})
+
+    def recipe_form(self, image, ingredients=8):
+        ingredients = self.rnd.sample(
+            self.ingredient_ids, min(ingredients, len(self.ingredient_ids)))
+        return {
+            'ingredients': [{'id': pk, 'amount': self.rnd.randint(1, 500)}
+                            for pk in ingredients],
+            'tags': [self.rnd.choice(self.tag_ids)],
+            'image': image,
+            'name': 'Рецепт для замера',
+            'text': 'Создан командой benchmark.',
+            'cooking_time': 10,
+        }
+
+    def get_photo(self):
+        if self.photo is None:
+            self.photo = photo()
+        return self.photo
+
+    def scenario_recipe_create(self):
+        return self.any_user(), 'post', '/api/recipes/', self.recipe_form(
+            IMAGE)
+
+    def scenario_recipe_update(self):
+        """The author rewrites a recipe with 50 ingredients."""
+        recipe_id = self.rnd.choice(self.recipe_ids)
+        return (self.recipe_authors[recipe_id], 'put',
+                f'/api/recipes/{recipe_id}/',
+                self.recipe_form(IMAGE, ingredients=50))
+
+    def scenario_recipe_create_photo(self):
+        image = ('data:image/jpeg;base64,'
+                 + base64.b64encode(self.get_photo()).decode())
+        return self.any_user(), 'post', '/api/recipes/', self.recipe_form(
+            image)
+
+    def scenario_recipe_create_upload(self):
+        """The same photo as a multipart file part."""
+        form = self.recipe_form(SimpleUploadedFile(
+            'photo.jpg', self.get_photo(), 'image/jpeg'))
+        ingredients = form.pop('ingredients')
+        for index, item in enumerate(ingredients):
+            form[f'ingredients[{index}]id'] = item['id']
+            form[f'ingredients[{index}]amount'] = item['amount']
+        return self.any_user(), 'post', '/api/recipes/', form
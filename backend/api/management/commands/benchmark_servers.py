@@ -0,0 +1,221 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from recipes.models import Follow, Ingredient, Recipe
+from rest_framework.authtoken.models import Token
+
+from .benchmark import percentile
+
+SERVERS = {
+    'wsgi': ['foodgramm.wsgi:application'],
+    'asgi': ['foodgramm.asgi:application',
+             '--worker-class', 'uvicorn.workers.UvicornWorker'],
+}
+HOST = '127.0.0.1'
+# Not an INTERNAL_IPS address, so the debug toolbar stays out of the way.
+CLIENT_HOST = '127.0.0.2'
+TIMEOUT = 10
+
+
+async def read_response(reader):
+    """Read one HTTP/1.1 response; return the status and keep-alive."""
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin1').split('\r\n')
+    status = int(lines[0].split()[1])
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip().lower()
+    if headers.get('transfer-encoding') == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if not size:
+                break
+    elif 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    return status, headers.get('connection') != 'close'
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает gunicorn с синхронными воркерами (WSGI) и с '
+            'воркерами uvicorn (ASGI) под параллельными keep-alive '
+            'клиентами и медленными загрузками; работает с текущей базой')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--server', action='append', default=[],
+                            choices=sorted(SERVERS))
+        parser.add_argument('--workers', type=int, default=2)
+        parser.add_argument('--clients', type=int, default=32,
+                            help='Параллельных keep-alive клиентов')
+        parser.add_argument('--slow-clients', type=int, default=0,
+                            help='Клиентов, которые медленно отправляют '
+                                 'тело POST, как загрузка фото')
+        parser.add_argument('--duration', type=float, default=10,
+                            help='Секунд на каждый сервер')
+        parser.add_argument('--port', type=int, default=8765)
+
+    def handle(self, *args, **options):
+        follow = Follow.objects.order_by('id').first()
+        recipe_ids = list(Recipe.objects.order_by('-id')
+                          .values_list('id', flat=True)[:100])
+        if not follow or not recipe_ids:
+            raise CommandError('Сначала заполните базу: benchmark --keep')
+        token, _ = Token.objects.get_or_create(user_id=follow.user_id)
+        self.token = token.key
+        prefix = Ingredient.objects.order_by('id').values_list(
+            'name', flat=True).first()[:2]
+        self.paths = [
+            '/api/recipes/?page=1&limit=6',
+            '/api/recipes/?page=2&limit=6&is_favorited=true',
+            *(f'/api/recipes/{pk}/' for pk in recipe_ids[:20]),
+            '/api/tags/',
+            f'/api/ingredients/?name={quote(prefix)}',
+            '/api/users/subscriptions/?page=1&limit=6&recipes_limit=3',
+        ]
+        results = {}
+        for name in options['server'] or sorted(SERVERS, reverse=True):
+            with self.server(name, options):
+                results[name] = asyncio.run(self.load(options))
+        self.print_report(results)
+
+    def server(self, name, options):
+        command = [
+            sys.executable, '-m', 'gunicorn', *SERVERS[name],
+            '--workers', str(options['workers']),
+            '--bind', f'0.0.0.0:{options["port"]}',
+            '--chdir', settings.BASE_DIR, '--log-level', 'warning',
+        ]
+        process = subprocess.Popen(command, env=os.environ.copy())
+        started = time.monotonic()
+        while asyncio.run(self.probe(options['port'])) != 200:
+            if process.poll() is not None:
+                raise CommandError(f'{name}: сервер не запустился')
+            if time.monotonic() - started > 60:
+                process.terminate()
+                raise CommandError(f'{name}: сервер не отвечает')
+            time.sleep(0.5)
+        return ServerProcess(process)
+
+    async def connect(self, port):
+        return await asyncio.open_connection(
+            HOST, port, local_addr=(CLIENT_HOST, 0))
+
+    async def probe(self, port):
+        try:
+            reader, writer = await self.connect(port)
+            writer.write(self.request('/api/tags/'))
+            status, _ = await asyncio.wait_for(read_response(reader), 5)
+            writer.close()
+            return status
+        except (OSError, asyncio.TimeoutError, ValueError,
+                asyncio.IncompleteReadError):
+            return None
+
+    def request(self, path):
+        return (f'GET {path} HTTP/1.1\r\nHost: {HOST}\r\n'
+                f'Authorization: Token {self.token}\r\n\r\n').encode()
+
+    async def load(self, options):
+        port = options['port']
+        deadline = time.monotonic() + options['duration']
+        timings, errors = [], []
+        slow = [asyncio.ensure_future(self.slow_client(port, deadline))
+                for _ in range(options['slow_clients'])]
+        await asyncio.sleep(0.2 if slow else 0)
+        await asyncio.gather(*(
+            self.client(port, deadline, number, timings, errors)
+            for number in range(options['clients'])))
+        for task in slow:
+            task.cancel()
+        await asyncio.gather(*slow, return_exceptions=True)
+        return {
+            'rps': len(timings) / options['duration'],
+            'p50': percentile(timings, 0.5) if timings else 0,
+            'p95': percentile(timings, 0.95) if timings else 0,
+            'p99': percentile(timings, 0.99) if timings else 0,
+            'errors': len(errors),
+        }
+
+    async def client(self, port, deadline, number, timings, errors):
+        """A keep-alive client that reconnects when the server closes."""
+        connection = None
+        request = number
+        while time.monotonic() < deadline:
+            path = self.paths[request % len(self.paths)]
+            request += 1
+            started = time.perf_counter()
+            try:
+                if connection is None:
+                    connection = await asyncio.wait_for(
+                        self.connect(port), TIMEOUT)
+                reader, writer = connection
+                writer.write(self.request(path))
+                status, keep_alive = await asyncio.wait_for(
+                    read_response(reader), TIMEOUT)
+            except (OSError, asyncio.TimeoutError,
+                    asyncio.IncompleteReadError) as error:
+                errors.append(error)
+                if connection:
+                    connection[1].close()
+                connection = None
+                continue
+            if status != 200:
+                errors.append(status)
+            else:
+                timings.append((time.perf_counter() - started) * 1000)
+            if not keep_alive:
+                connection[1].close()
+                connection = None
+        if connection:
+            connection[1].close()
+
+    async def slow_client(self, port, deadline):
+        """Send a recipe body a few bytes at a time, like a slow upload."""
+        body = b'{"name": "' + b'x' * 4096 + b'"}'
+        while time.monotonic() < deadline:
+            reader, writer = await self.connect(port)
+            writer.write(
+                f'POST /api/recipes/ HTTP/1.1\r\nHost: {HOST}\r\n'
+                f'Authorization: Token {self.token}\r\n'
+                f'Content-Type: application/json\r\n'
+                f'Content-Length: {len(body)}\r\n\r\n'.encode())
+            try:
+                for start in range(0, len(body), 16):
+                    writer.write(body[start:start + 16])
+                    await writer.drain()
+                    await asyncio.sleep(0.2)
+                await read_response(reader)
+            except (OSError, asyncio.IncompleteReadError):
+                pass
+            finally:
+                writer.close()
+
+    def print_report(self, results):
+        self.stdout.write(f'{"сервер":<8}{"запр/с":>10}{"p50, мс":>10}'
+                          f'{"p95, мс":>10}{"p99, мс":>10}{"ошибки":>9}')
+        for name, result in results.items():
+            self.stdout.write(
+                f'{name:<8}{result["rps"]:>10.1f}{result["p50"]:>10.2f}'
+                f'{result["p95"]:>10.2f}{result["p99"]:>10.2f}'
+                f'{result["errors"]:>9}')
+
+
+class ServerProcess:
+
+    def __init__(self, process):
+        self.process = process
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        self.process.wait(TIMEOUT)
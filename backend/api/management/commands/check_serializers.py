@@ -0,0 +1,109 @@
+import time
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from recipes.models import Favorite, Follow, ShoppingCart
+from rest_framework.renderers import JSONRenderer
+from users.models import User
+
+from api.cards import CardRecipeSerializer
+from api.renderers import FastJSONRenderer
+from api.serializers import LeanRecipeSerializer, RecipeSerializer
+from api.views import RecipeViewSet
+
+
+def recipe_view(user, action):
+    request = RequestFactory().get('/api/recipes/')
+    request.user = user
+    return RecipeViewSet(request=request, action=action, kwargs={},
+                         format_kwarg=None)
+
+
+def per_item(func, items, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat / max(items, 1) * 10**6
+
+
+class Command(BaseCommand):
+    help = ('Сверяет на рабочих данных JSON рецептов от '
+            'LeanRecipeSerializer, CardRecipeSerializer с сохранёнными '
+            'карточками и FastJSONRenderer с RecipeSerializer и '
+            'JSONRenderer (в тестах это делает SerializerContractTest) и '
+            'замеряет время сериализации одного рецепта')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipes', type=int, default=500,
+                            help='Сколько последних рецептов сверять')
+        parser.add_argument('--limit', type=int, default=50,
+                            help='Рецептов на страницу')
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='Повторов замера')
+
+    def handle(self, *args, **options):
+        # Someone with favourites, a cart and follows, for the flags.
+        viewers = [AnonymousUser()] + [
+            User.objects.filter(id__in=model.objects.values('user_id'))
+            .order_by('id').first()
+            for model in (Favorite, ShoppingCart, Follow)]
+        viewers = [user for user in viewers if user is not None]
+        limit = options['limit']
+        checked = carded = 0
+        for user in viewers:
+            lean_view = recipe_view(user, 'list')
+            view = recipe_view(user, 'retrieve')
+            context = {'request': lean_view.request}
+            rows = list(lean_view.get_queryset()[:options['recipes']])
+            for start in range(0, len(rows), limit):
+                page = rows[start:start + limit]
+                recipes = view.get_queryset().in_bulk(
+                    [row['id'] for row in page])
+                expected = JSONRenderer().render(RecipeSerializer(
+                    [recipes[row['id']] for row in page], many=True,
+                    context=context).data)
+                for serializer in (LeanRecipeSerializer,
+                                   CardRecipeSerializer):
+                    actual = FastJSONRenderer().render(
+                        serializer(page, context=context).data)
+                    if actual != expected:
+                        raise CommandError(
+                            f'{serializer.__name__}: расходится JSON '
+                            f'рецептов {page[0]["id"]}–{page[-1]["id"]} '
+                            f'для пользователя {user.id or "анонимный"}')
+                checked += len(page)
+                carded += sum(1 for row in page if row['card'])
+        self.stdout.write(f'Сверено рецептов: {checked}, из них с '
+                          f'карточкой: {carded}, пользователей: '
+                          f'{len(viewers)}, расхождений нет')
+        self.print_timings(viewers[-1], limit, options['repeat'])
+
+    def print_timings(self, user, limit, repeat):
+        """Time one page with every query already made."""
+        lean_view = recipe_view(user, 'list')
+        context = {'request': lean_view.request}
+        rows = list(lean_view.get_queryset()[:limit])
+        lean = LeanRecipeSerializer(rows, context=context)
+        lean.related = {name: query()
+                        for name, query in lean.related_queries().items()}
+        cards = CardRecipeSerializer(rows, context=context)
+        cards.related = {name: query()
+                         for name, query in cards.related_queries().items()}
+        recipes = list(recipe_view(user, 'retrieve').get_queryset()[:limit])
+        data = lean.data
+        card_data = cards.data
+        timings = {
+            'RecipeSerializer': lambda: RecipeSerializer(
+                recipes, many=True, context=context).data,
+            'LeanRecipeSerializer': lambda: lean.data,
+            'CardRecipeSerializer': lambda: cards.data,
+            'JSONRenderer': lambda: JSONRenderer().render(data),
+            'FastJSONRenderer': lambda: FastJSONRenderer().render(data),
+            'FastJSONRenderer, карточки': lambda: FastJSONRenderer().render(
+                card_data),
+        }
+        self.stdout.write(f'{"":<28}{"мкс на рецепт":>14}')
+        for name, func in timings.items():
+            self.stdout.write(
+                f'{name:<28}{per_item(func, len(rows), repeat):>14.1f}')
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from recipes.models import Recipe
+
+from api.cards import refresh_cards
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает сохранённые карточки рецептов для списков'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            refresh_cards(Recipe.objects.values_list('id', flat=True))
+        self.stdout.write('Карточки рецептов пересобраны')
@@ -1,17 +1,58 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
 from django.shortcuts import get_object_or_404
+from foodgramm.routers import PIN_KEY, replica_reads
 from recipes.models import Recipe
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
 from rest_framework.mixins import (CreateModelMixin, DestroyModelMixin,
                                    ListModelMixin, RetrieveModelMixin)
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import SAFE_METHODS, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
+from users.models import User
+
+from .cache import bump, user_namespace
+from .serializers import BulkIdsSerializer
+
+
+def lock_users(user_ids):
+    """
+    Lock the rows of the users until the end of the transaction. Every
+    write to a user's favourites, cart or subscriptions takes the lock of
+    that user first, and of the author followed or left, always in id
+    order so that two such writes cannot deadlock.
+    """
+    list(User.objects.select_for_update().filter(id__in=user_ids)
+         .order_by('id').values_list('id', flat=True))
 
 
 class ListRetriveViewSet(ListModelMixin, RetrieveModelMixin, GenericViewSet):
     pass
 
 
+class ReplicaReadMixin:
+    """
+    Sends the reads of the safe methods to the replica database, if there
+    is one (see foodgramm.routers), unless ReplicaMiddleware has pinned
+    the user to the primary after a write. Cached actions are built from
+    the primary: a lagging replica would put an old response in the cache
+    under the version that the write has just bumped.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        reads = replica_reads.get()
+        if (reads is None or request.method not in SAFE_METHODS
+                or self.action in getattr(self, 'cached_actions', ())):
+            return
+        user = request.user
+        if user.is_authenticated and cache.get(PIN_KEY.format(user.id)):
+            return
+        reads.enabled = True
+
+
 class FollowMixin(CreateModelMixin, DestroyModelMixin, GenericViewSet):
     pass
 
@@ -19,18 +60,124 @@ class FollowMixin(CreateModelMixin, DestroyModelMixin, GenericViewSet):
 class FavoritMixin(FollowMixin):
     permission_classes = (IsAuthenticated,)
     lookup_field = 'recipe_id'
+    counter_field = None
+
+    def change_counter(self, recipe, delta):
+        if self.counter_field:
+            Recipe.objects.filter(id=recipe.id).update(
+                **{self.counter_field: F(self.counter_field) + delta})
 
+    @transaction.atomic
     def perform_create(self, serializer):
         recipe = get_object_or_404(Recipe, id=self.kwargs.get('recipe_id'))
+        lock_users([self.request.user.id])
+        # Checked under the lock: a batch may have just added the recipe.
+        if self.model.objects.filter(user=self.request.user,
+                                     recipes=recipe).exists():
+            raise ValidationError('Такой рецепт уже добавлен')
         serializer.save(user=self.request.user, recipes=recipe)
+        self.change_counter(recipe, 1)
 
+    @transaction.atomic
     def destroy(self, request, *args, **kwargs):
         recipe = get_object_or_404(Recipe, id=self.kwargs.get('recipe_id'))
         user = self.request.user
+        lock_users([user.id])
         instance = get_object_or_404(self.model, recipes=recipe, user=user)
         self.perform_destroy(instance)
+        self.change_counter(recipe, -1)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     def get_queryset(self):
         recipe = get_object_or_404(Recipe, id=self.kwargs.get('recipe_id'))
         return self.model.objects.filter(recipes=recipe)
+
+
+class BulkToggleViewSet(GenericViewSet):
+    """
+    Adds (POST) or removes (DELETE) a list of {"ids": [...]} for the user
+    at once and answers with the outcome of every id. The ids are checked
+    with one query under lock_users(), so only rows that were really
+    missing are inserted and counted; bulk_create(ignore_conflicts) covers
+    writers outside the API such as the admin. Neither bulk_create nor
+    update() sends signals, so counters and cached responses are kept in
+    step here.
+    """
+    permission_classes = (IsAuthenticated,)
+    serializer_class = BulkIdsSerializer
+    model = None
+    target_model = Recipe
+    target_field = 'recipes'
+    counter_field = None
+
+    def change_counters(self, target_ids, delta):
+        if self.counter_field:
+            self.target_model.objects.filter(id__in=target_ids).update(
+                **{self.counter_field: F(self.counter_field) + delta})
+
+    def locked_users(self, target_ids):
+        return [self.request.user.id]
+
+    def refused(self, target_id):
+        return False
+
+    def prepare(self, request):
+        """The requested ids, those that exist and those already added."""
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = serializer.validated_data['ids']
+        # The single toggles take the same lock, so the rows read below
+        # stay as they are until the batch is written and counted.
+        lock_users(self.locked_users(ids))
+        found = set(self.target_model.objects.filter(
+            id__in=ids).values_list('id', flat=True))
+        added = set(self.get_queryset().filter(**{
+            f'{self.target_field}_id__in': found}).values_list(
+                f'{self.target_field}_id', flat=True))
+        return ids, found, added
+
+    def get_queryset(self):
+        return self.model.objects.filter(user=self.request.user)
+
+    def results(self, ids, statuses):
+        return Response({'results': [
+            {'id': target_id, 'status': statuses[target_id]}
+            for target_id in ids]})
+
+    @transaction.atomic
+    def create(self, request, *args, **kwargs):
+        ids, found, added = self.prepare(request)
+        statuses = {}
+        for target_id in ids:
+            if target_id not in found:
+                statuses[target_id] = 'not_found'
+            elif target_id in added:
+                statuses[target_id] = 'exists'
+            elif self.refused(target_id):
+                statuses[target_id] = 'refused'
+            else:
+                statuses[target_id] = 'created'
+        created = [target_id for target_id in ids
+                   if statuses[target_id] == 'created']
+        if created:
+            self.model.objects.bulk_create([
+                self.model(user=request.user,
+                           **{f'{self.target_field}_id': target_id})
+                for target_id in created], ignore_conflicts=True)
+            self.change_counters(created, 1)
+            bump(user_namespace(request.user.id))
+        return self.results(ids, statuses)
+
+    @transaction.atomic
+    def destroy(self, request, *args, **kwargs):
+        ids, found, added = self.prepare(request)
+        statuses = {
+            target_id: 'deleted' if target_id in added else
+            'missing' if target_id in found else 'not_found'
+            for target_id in ids}
+        if added:
+            self.change_counters(sorted(added), -1)
+            # Sends post_delete, which retires the cached responses.
+            self.get_queryset().filter(**{
+                f'{self.target_field}_id__in': added}).delete()
+        return self.results(ids, statuses)
@@ -1,6 +1,68 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+MAX_PAGE_SIZE = 100
 
 
 class CustomPaginator(PageNumberPagination):
     page_size = 6
-    page_size_query_params = 'page_size'
+    page_size_query_param = 'limit'
+    max_page_size = MAX_PAGE_SIZE
+
+
+class KeysetPaginator(CursorPagination):
+    page_size = 6
+    page_size_query_param = 'limit'
+    max_page_size = MAX_PAGE_SIZE
+    ordering = '-id'
+
+
+class OptInCursorPaginator(CustomPaginator):
+    """
+    Page numbers with a total count by default, for the existing
+    page/limit contract. A request carrying ?cursor= (empty for the first
+    page) switches to keyset pagination on -id: no COUNT(*), no OFFSET and
+    stable pages while new rows are inserted. The cursor only walks -id,
+    so it is refused for a search or a custom ordering.
+    """
+    keyset_class = KeysetPaginator
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if self.keyset_class.cursor_query_param in request.query_params:
+            if queryset.query.order_by:
+                raise ValidationError({
+                    self.keyset_class.cursor_query_param: [
+                        'Курсор нельзя сочетать с поиском и сортировкой']})
+            self.keyset = self.keyset_class()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+
+class FetchedPage:
+    """
+    One page of rows fetched ahead of time together with the total count,
+    standing in for the queryset so the paginator validates the page and
+    builds its response without querying again.
+    """
+
+    def __init__(self, rows, total, offset):
+        self.rows = rows
+        self.total = total
+        self.offset = offset
+
+    def count(self):
+        return self.total
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, window):
+        if window.start != self.offset:
+            raise IndexError(window)
+        return self.rows
@@ -0,0 +1,178 @@
+import heapq
+import logging
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from itertools import chain
+
+from django.db import close_old_connections, transaction
+from recipes.models import RecipeIngredient
+
+from .cache import advance, get_version
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE = 'pantry'
+
+
+def build_postings(pairs):
+    """Recipe and ingredient id pairs, ordered by recipe id."""
+    recipes = defaultdict(lambda: array('I'))
+    postings = defaultdict(lambda: array('I'))
+    for recipe_id, ingredient_id in pairs:
+        recipes[recipe_id].append(ingredient_id)
+        postings[ingredient_id].append(recipe_id)
+    return dict(recipes), dict(postings)
+
+
+def without(ids, value):
+    index = bisect_left(ids, value)
+    if index < len(ids) and ids[index] == value:
+        ids = ids[:index] + ids[index + 1:]
+    return ids
+
+
+def with_(ids, value):
+    index = bisect_left(ids, value)
+    if index < len(ids) and ids[index] == value:
+        return ids
+    return ids[:index] + array('I', [value]) + ids[index:]
+
+
+class PantryIndex:
+    """
+    In-process inverted index from ingredient id to the sorted ids of the
+    recipes using it, for ranking recipes by how well a set of ingredients
+    covers them.
+    Built once per worker. Recipes written by this process are reloaded
+    after the commit and patched in place; a change made elsewhere moves
+    the shared pantry version and the index is rebuilt in a background
+    thread while the previous one keeps answering. Arrays are replaced,
+    never modified, so readers need no lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._pending = threading.local()
+        self._version = None
+        self._recipes = {}
+        self._postings = {}
+        self._rebuilding = False
+
+    def _build(self):
+        version = get_version(NAMESPACE)
+        pairs = (RecipeIngredient.objects.order_by('recipe_id')
+                 .values_list('recipe_id', 'ingredient_id')
+                 .iterator(chunk_size=10000))
+        recipes, postings = build_postings(pairs)
+        with self._lock:
+            self._recipes, self._postings = recipes, postings
+            self._version = version
+
+    def _rebuild_in_background(self):
+        try:
+            with self._build_lock:
+                self._build()
+        except Exception:
+            logger.exception('Не удалось перестроить индекс ингредиентов')
+        finally:
+            self._rebuilding = False
+            close_old_connections()
+
+    def _refresh(self):
+        if self._version is None:
+            with self._build_lock:
+                if self._version is None:
+                    self._build()
+            return
+        if self._version == get_version(NAMESPACE) or self._rebuilding:
+            return
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self._rebuild_in_background,
+                         daemon=True).start()
+
+    def warm(self):
+        """Build the index without holding up the caller."""
+        if self._version is None and not self._rebuilding:
+            self._rebuilding = True
+            threading.Thread(target=self._rebuild_in_background,
+                             daemon=True).start()
+
+    def schedule(self, recipe_ids):
+        """
+        Reload the recipes once the current transaction commits. Signals
+        fire per row, so the ids are collected and the first callback
+        reloads them all; reloading is idempotent, so ids left behind by
+        a rollback do no harm.
+        """
+        pending = self._pending.__dict__.setdefault('recipe_ids', set())
+        pending.update(recipe_ids)
+        transaction.on_commit(self._flush)
+
+    def _flush(self):
+        recipe_ids = getattr(self._pending, 'recipe_ids', None)
+        self._pending.recipe_ids = set()
+        if recipe_ids:
+            self.recipes_changed(recipe_ids)
+
+    def recipes_changed(self, recipe_ids):
+        """Reload the ingredients of recipes after they were written."""
+        recipe_ids = set(recipe_ids)
+        recipes, _ = build_postings(
+            RecipeIngredient.objects.filter(recipe_id__in=recipe_ids)
+            .order_by('recipe_id', 'ingredient_id')
+            .values_list('recipe_id', 'ingredient_id'))
+        version = advance(NAMESPACE)
+        with self._lock:
+            if self._version is None:
+                return
+            if version != self._version + 1:
+                # Someone else changed the index meanwhile: fall back to
+                # a rebuild on the next read.
+                return
+            for recipe_id in recipe_ids:
+                self._replace(recipe_id, recipes.get(recipe_id, array('I')))
+            self._version = version
+
+    def _replace(self, recipe_id, ingredients):
+        old = self._recipes.get(recipe_id, array('I'))
+        for ingredient_id in set(old) - set(ingredients):
+            self._postings[ingredient_id] = without(
+                self._postings[ingredient_id], recipe_id)
+        for ingredient_id in set(ingredients) - set(old):
+            self._postings[ingredient_id] = with_(
+                self._postings.get(ingredient_id, array('I')), recipe_id)
+        if ingredients:
+            self._recipes[recipe_id] = ingredients
+        else:
+            self._recipes.pop(recipe_id, None)
+
+    def rank(self, ingredient_ids, limit):
+        """
+        Recipes sharing at least one of the ingredients, best first: the
+        fewest missing ingredients, then the highest Jaccard similarity,
+        then the newest. Returns (recipe_id, missing, jaccard) triples.
+        """
+        self._refresh()
+        have = set(ingredient_ids)
+        recipes, postings = self._recipes, self._postings
+        matched = Counter(chain.from_iterable(
+            postings.get(ingredient_id, ()) for ingredient_id in have))
+        ranked = []
+        for recipe_id, common in matched.items():
+            total = len(recipes.get(recipe_id, ()))
+            if not total:
+                continue
+            jaccard = common / (total + len(have) - common)
+            ranked.append((total - common, -jaccard, -recipe_id))
+        return [(-recipe_id, missing, -jaccard)
+                for missing, jaccard, recipe_id
+                in heapq.nsmallest(limit, ranked)]
+
+
+pantry_index = PantryIndex()
@@ -0,0 +1,31 @@
+from collections import defaultdict
+
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+from recipes.models import Recipe
+
+PREVIEW_FIELDS = ('id', 'author_id', 'name', 'image', 'cooking_time')
+
+
+def recipe_previews(author_ids, limit=None):
+    """
+    Latest recipes of every author, newest first, at most limit each,
+    fetched with a single query.
+    """
+    recipes = Recipe.objects.filter(author_id__in=author_ids)
+    if limit is None:
+        rows = recipes.only(*PREVIEW_FIELDS).order_by('-id')
+    else:
+        # Django cannot filter on a window function yet, so the ranked
+        # query is wrapped by hand.
+        ranked = recipes.annotate(recipe_rank=Window(
+            RowNumber(), partition_by=[F('author_id')],
+            order_by=F('id').desc())).values(*PREVIEW_FIELDS, 'recipe_rank')
+        sql, params = ranked.query.sql_with_params()
+        rows = Recipe.objects.raw(
+            f'SELECT * FROM ({sql}) ranked WHERE recipe_rank <= %s '
+            f'ORDER BY author_id, recipe_rank', (*params, limit))
+    previews = defaultdict(list)
+    for recipe in rows:
+        previews[recipe.author_id].append(recipe)
+    return previews
@@ -0,0 +1,82 @@
+import json
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Dates and times go through the DRF encoder, which formats them its own way.
+ORJSON_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+                  if orjson else 0)
+# orjson 3.9 and later put rendered JSON into the output as it is.
+Fragment = getattr(orjson, 'Fragment', None)
+
+
+class RawJSON(bytes):
+    """A value rendered to JSON ahead of time, e.g. a stored card."""
+
+
+class RawJSONEncoder(JSONEncoder):
+
+    def default(self, obj):
+        if isinstance(obj, RawJSON):
+            return json.loads(obj)
+        return super().default(obj)
+
+
+class ExportRenderer(BaseRenderer):
+    """
+    Lets DRF content negotiation accept ?format= for file exports.
+    Successful exports bypass rendering with a streaming response, so only
+    error details ever reach render().
+    """
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, dict):
+            data = '\n'.join(f'{key}: {value}' for key, value in data.items())
+        return str(data or '').encode(self.charset)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    Renders the bytes JSONRenderer would, with orjson when it is installed.
+    Indented, ASCII-only or non-compact output, and data orjson refuses,
+    are left to JSONRenderer. RawJSON is copied into the output by orjson
+    and parsed again for JSONRenderer.
+    """
+    encoder_class = RawJSONEncoder
+
+    def default(self, obj):
+        if Fragment is not None and isinstance(obj, RawJSON):
+            return Fragment(bytes(obj))
+        return self.encoder_class().default(obj)
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if (orjson is None or data is None or indent is not None
+                or self.ensure_ascii or not self.compact):
+            return super().render(data, accepted_media_type,
+                                  renderer_context)
+        try:
+            ret = orjson.dumps(data, default=self.default,
+                               option=ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type,
+                                  renderer_context)
+        # Escaped like JSONRenderer does, to stay valid JavaScript.
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace(
+            '\u2029'.encode(), b'\\u2029')
+
+
+class TextRenderer(ExportRenderer):
+    media_type = 'text/plain'
+    format = 'txt'
+
+
+class CSVRenderer(ExportRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
@@ -1,14 +1,48 @@
+from collections import defaultdict
+from functools import partial
+
+from django.core.files.storage import default_storage
 from django.core.validators import MinValueValidator
+from django.db import transaction
+from django.db.models import (Exists, F, OuterRef, Prefetch,
+                              prefetch_related_objects)
 from django.shortcuts import get_object_or_404
 from djoser.serializers import UserCreateSerializer, UserSerializer
-from .fields import Base64ImageField
+from .fields import Base64ImageField, PrimaryKeyListField
+from .pantry import pantry_index
+from recipes.images import schedule_variants, stored_files
 from recipes.models import (Favorite, Follow, Ingredient, Recipe,
                             RecipeIngredient, ShoppingCart, Tag)
+from recipes.search import index_recipes
+from recipes.shopping import cart_users, shift_lists
 from rest_framework import serializers
 from users.models import User
 
 # from .fields import ImageField
 
+MAX_BULK_IDS = 100
+
+# The .values() of a recipe row that LeanRecipeSerializer renders.
+LEAN_RECIPE_FIELDS = ('id', 'author_id', 'name', 'text', 'image',
+                      'image_variants', 'cooking_time', 'is_favorited',
+                      'is_in_shopping_cart')
+# CardRecipeSerializer also needs the stored card and the author flag.
+CARD_RECIPE_FIELDS = LEAN_RECIPE_FIELDS + ('card', 'is_subscribed')
+
+
+def absolute_url(name, request):
+    url = default_storage.url(name)
+    return request.build_absolute_uri(url) if request else url
+
+
+def image_variant_urls(image_variants, request):
+    variants = {}
+    for label, files in image_variants.items():
+        variants[label] = {}
+        for extension, name in files.items():
+            variants[label][extension] = absolute_url(name, request)
+    return variants
+
 
 class ModUserSerializer(UserSerializer):
     is_subscribed = serializers.SerializerMethodField(read_only=True)
@@ -20,6 +54,8 @@ class ModUserSerializer(UserSerializer):
         read_only_fields = ['id']
 
     def get_is_subscribed(self, author):
+        if hasattr(author, 'is_subscribed'):
+            return author.is_subscribed
         user = self.context.get('request').user
         return not user.is_anonymous and Follow.objects.filter(
             user=user,
@@ -64,6 +100,7 @@ class RecipesIngredientsSerializer(serializers.ModelSerializer):
 
 class RecipeSerializer(serializers.ModelSerializer):
     image = Base64ImageField()
+    image_variants = serializers.SerializerMethodField()
     tags = TagSerializer(many=True)
     author = ModUserSerializer(read_only=True)
     ingredients = RecipesIngredientsSerializer(source='recipe_ingredient',
@@ -76,11 +113,18 @@ class RecipeSerializer(serializers.ModelSerializer):
         fields = ('id', 'tags', 'author',
                   'ingredients', 'name',
                   'text', 'image',
+                  'image_variants',
                   'cooking_time',
                   'is_favorited',
                   'is_in_shopping_cart',)
 
+    def get_image_variants(self, obj):
+        return image_variant_urls(obj.image_variants,
+                                  self.context.get('request'))
+
     def get_is_favorited(self, obj):
+        if hasattr(obj, 'is_favorited'):
+            return obj.is_favorited
         request = self.context.get('request')
         if not request or request.user.is_anonymous:
             return False
@@ -88,16 +132,115 @@ class RecipeSerializer(serializers.ModelSerializer):
             user=request.user, recipes=obj).exists()
 
     def get_is_in_shopping_cart(self, obj):
-        user = self.context['request'].user.id
-        return ShoppingCart.objects.filter(user=user).exists()
+        if hasattr(obj, 'is_in_shopping_cart'):
+            return obj.is_in_shopping_cart
+        request = self.context.get('request')
+        if not request or request.user.is_anonymous:
+            return False
+        return ShoppingCart.objects.filter(
+            user=request.user, recipes=obj).exists()
+
+
+def recipe_authors(author_ids, user_id):
+    authors = User.objects.filter(id__in=author_ids).annotate(
+        is_subscribed=Exists(Follow.objects.filter(
+            user_id=user_id, author_id=OuterRef('id'))))
+    return {
+        author_id: {'email': email, 'id': author_id, 'username': username,
+                    'first_name': first_name, 'last_name': last_name,
+                    'is_subscribed': is_subscribed}
+        for author_id, email, username, first_name, last_name, is_subscribed
+        in authors.values_list('id', 'email', 'username', 'first_name',
+                               'last_name', 'is_subscribed')}
+
+
+def recipe_tags(recipe_ids):
+    # Same join and order as prefetching Recipe.tags.
+    tags = defaultdict(list)
+    for recipe_id, tag_id, slug, color, name in Tag.objects.filter(
+            recipe__in=recipe_ids).values_list(
+                'recipe__id', 'id', 'slug', 'color', 'name'):
+        tags[recipe_id].append(
+            {'id': tag_id, 'slug': slug, 'color': color, 'name': name})
+    return tags
+
+
+def recipe_ingredients(recipe_ids):
+    ingredients = defaultdict(list)
+    for recipe_id, ingredient_id, name, unit, amount in (
+            RecipeIngredient.objects.filter(recipe__in=recipe_ids)
+            .values_list('recipe_id', 'ingredient_id', 'ingredient__name',
+                         'ingredient__measurement_unit', 'amount')):
+        ingredients[recipe_id].append(
+            {'id': ingredient_id, 'name': name, 'measurement_unit': unit,
+             'amount': float(amount)})
+    return ingredients
+
+
+class LeanRecipeSerializer:
+    """
+    Read-only stand-in for RecipeSerializer(many=True) on collections.
+    Takes rows of LEAN_RECIPE_FIELDS and builds the same dicts by hand,
+    with the authors, tags and ingredients of all rows from three flat
+    queries and no field or model instance per item. Must render the same
+    JSON as RecipeSerializer, which SerializerContractTest checks.
+    """
+    many = True
+
+    def __init__(self, instance=None, context=None, **kwargs):
+        self.instance = instance
+        self.context = context or {}
+        self.related = None
+
+    def built_rows(self):
+        """The rows that to_representation() builds from the lookups."""
+        return self.instance
+
+    def related_queries(self):
+        """The lookups for the rows, independent of each other."""
+        request = self.context.get('request')
+        user_id = request.user.id if request else None
+        rows = self.built_rows()
+        recipe_ids = [row['id'] for row in rows]
+        return {
+            'authors': partial(
+                recipe_authors,
+                {row['author_id'] for row in rows}, user_id),
+            'tags': partial(recipe_tags, recipe_ids),
+            'ingredients': partial(recipe_ingredients, recipe_ids),
+        }
+
+    @property
+    def data(self):
+        if self.related is None:
+            self.related = {name: query() for name, query
+                            in self.related_queries().items()}
+        return [self.to_representation(row) for row in self.instance]
+
+    def to_representation(self, row):
+        request = self.context.get('request')
+        return {
+            'id': row['id'],
+            'tags': self.related['tags'].get(row['id'], []),
+            'author': self.related['authors'][row['author_id']],
+            'ingredients': self.related['ingredients'].get(row['id'], []),
+            'name': row['name'],
+            'text': row['text'],
+            'image': (absolute_url(row['image'], request)
+                      if row['image'] else None),
+            'image_variants': image_variant_urls(row['image_variants'],
+                                                 request),
+            'cooking_time': row['cooking_time'],
+            'is_favorited': row['is_favorited'],
+            'is_in_shopping_cart': row['is_in_shopping_cart'],
+        }
 
 
 class RecipeSerializerCreate(serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
     ingredients = RecipesIngredientsSerializer(source='recipe_ingredient',
                                                many=True)
-    tags = serializers.PrimaryKeyRelatedField(
-        queryset=Tag.objects.all(), many=True)
+    tags = PrimaryKeyListField()
     image = Base64ImageField()
     cooking_time = serializers.IntegerField(validators=[MinValueValidator(1)])
 
@@ -115,71 +258,157 @@ class RecipeSerializerCreate(serializers.ModelSerializer):
         user = self.context.get('request').user
         return ShoppingCart.objects.filter(user=user, recipe=obj).exists()
 
-    def validate_ingredient(self, data):
-        ingredients = self.initial_data.get('ingredients')
-        ingredient_list = []
-        for ingredient_item in ingredients:
-            ingredient = get_object_or_404(
-                Ingredient, id=ingredient_item['id']
+    def validate_ingredients(self, data):
+        if not data:
+            raise serializers.ValidationError(
+                'Нужен минимум один ингредиент для рецепта'
             )
-            if ingredient in ingredient_list:
+        ids = [item['ingredient']['id'] for item in data]
+        if len(set(ids)) != len(ids):
+            raise serializers.ValidationError(
+                'ингредиент должен быть уникальным'
+            )
+        ingredients = Ingredient.objects.in_bulk(ids)
+        for ingredient_id in ids:
+            if ingredient_id not in ingredients:
                 raise serializers.ValidationError(
-                    'ингредиент должен быть уникальным'
+                    f'ингредиента с id = {ingredient_id} не существует'
                 )
 
-            ingredient_list.append(ingredient)
+        return [{'ingredient': ingredients[item['ingredient']['id']],
+                 'amount': item['amount']} for item in data]
 
-        tags = self.initial_data.get('tags')
-        if not tags:
+    def validate_tags(self, data):
+        if not data:
             raise serializers.ValidationError(
                 'Нужен минимум один тэг для рецепта'
             )
-        for tag_id in tags:
-            if not Tag.objects.filter(id=tag_id).exists():
+        tags = Tag.objects.in_bulk(data)
+        for tag_id in data:
+            if tag_id not in tags:
                 raise serializers.ValidationError(
                     f'тэга с id = {tag_id} не существует'
                 )
 
-        return data
+        return list(tags.values())
 
     def validate_cooking_time(self, data):
         if data <= 0:
             raise serializers.ValidationError('Время должно быть больше 0')
         return data
 
+    @transaction.atomic
     def create(self, validated_data):
         ingredients = validated_data.pop('recipe_ingredient')
         tags = validated_data.pop('tags')
         recipe = Recipe.objects.create(**validated_data)
+        User.objects.filter(id=recipe.author_id).update(
+            recipes_count=F('recipes_count') + 1)
         recipe.tags.set(tags)
-        set_of_ingredients = [RecipeIngredient(
-            recipe=recipe, ingredient=get_object_or_404(
-                Ingredient, id=item['ingredient']['id']), amount=item[
-                    'amount']) for item in ingredients]
-        RecipeIngredient.objects.bulk_create(set_of_ingredients)
+        RecipeIngredient.objects.bulk_create([RecipeIngredient(
+            recipe=recipe, ingredient=item['ingredient'],
+            amount=item['amount']) for item in ingredients])
+        index_recipes([recipe.id])
+        # bulk_create sends no signals.
+        pantry_index.schedule([recipe.id])
+        transaction.on_commit(lambda: schedule_variants(recipe))
 
         return recipe
 
+    def to_representation(self, instance):
+        prefetch_related_objects([instance], Prefetch(
+            'recipe_ingredient',
+            RecipeIngredient.objects.select_related('ingredient')))
+        return super().to_representation(instance)
+
+    @transaction.atomic
     def update(self, instance, validated_data):
-        ingredients = validated_data.pop('recipe_ingredient')
-        tags = validated_data.pop('tags')
+        ingredients = validated_data.pop('recipe_ingredient', None)
+        tags = validated_data.pop('tags', None)
+        if 'image' in validated_data:
+            replaced = stored_files(instance)
+            validated_data['image_variants'] = {}
         instance = super().update(instance, validated_data)
-        return self.validate_ingredient(ingredients, tags, instance)
+        if 'image' in validated_data:
+            transaction.on_commit(
+                lambda: schedule_variants(instance, replaced))
+        if tags is not None:
+            instance.tags.set(tags)
+        if ingredients is not None:
+            self.update_ingredients(instance, ingredients)
+            pantry_index.schedule([instance.id])
+        index_recipes([instance.id])
+        return instance
+
+    def update_ingredients(self, recipe, ingredients):
+        """
+        Compare the new ingredients with the stored rows and write only
+        the difference, with one bulk query per kind of change.
+        """
+        amounts = {item['ingredient'].id: item['amount']
+                   for item in ingredients}
+        stale, changed = [], []
+        # What the shopping lists holding the recipe have to move by.
+        shifts = {}
+        for row in recipe.recipe_ingredient.all():
+            amount = amounts.pop(row.ingredient_id, None)
+            if amount is None:
+                stale.append(row.id)
+                shifts[row.ingredient_id] = (-row.amount, -1)
+            elif row.amount != amount:
+                # Stored amounts are whole numbers.
+                shifts[row.ingredient_id] = (int(amount) - row.amount, 0)
+                row.amount = amount
+                changed.append(row)
+        if stale:
+            RecipeIngredient.objects.filter(id__in=stale).delete()
+        if changed:
+            RecipeIngredient.objects.bulk_update(changed, ['amount'])
+        if amounts:
+            RecipeIngredient.objects.bulk_create([RecipeIngredient(
+                recipe=recipe, ingredient_id=ingredient_id, amount=amount)
+                for ingredient_id, amount in amounts.items()])
+        shifts.update((ingredient_id, (int(amount), 1))
+                      for ingredient_id, amount in amounts.items())
+        shift_lists(cart_users(recipe.id), shifts)
+
+
+class RecipeShortSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = Recipe
+        fields = ('id', 'name', 'image', 'cooking_time',)
 
 
 class FollowSerializer(serializers.ModelSerializer):
-    email = serializers.EmailField(read_only=True)
-    id = serializers.IntegerField(read_only=True)
-    username = serializers.CharField(read_only=True)
-    first_name = serializers.CharField(read_only=True)
-    last_name = serializers.CharField(read_only=True)
-    recipes_count = serializers.IntegerField(read_only=True)
-    is_subscribed = serializers.BooleanField(read_only=True)
+    email = serializers.EmailField(source='author.email', read_only=True)
+    id = serializers.IntegerField(source='author.id', read_only=True)
+    username = serializers.CharField(source='author.username', read_only=True)
+    first_name = serializers.CharField(source='author.first_name',
+                                       read_only=True)
+    last_name = serializers.CharField(source='author.last_name',
+                                      read_only=True)
+    recipes_count = serializers.IntegerField(source='author.recipes_count',
+                                             read_only=True)
+    is_subscribed = serializers.SerializerMethodField(read_only=True)
     recipes = serializers.SerializerMethodField(read_only=True)
 
     class Meta:
         model = Follow
-        fields = ('__all__')
+        fields = ('email', 'id', 'username', 'first_name', 'last_name',
+                  'is_subscribed', 'recipes', 'recipes_count',)
+
+    def get_is_subscribed(self, obj):
+        return getattr(obj, 'is_subscribed', True)
+
+    def get_recipes(self, obj):
+        previews = self.context.get('recipe_previews')
+        if previews is None:
+            recipes = obj.author.recipe_set.all()
+        else:
+            recipes = previews.get(obj.author_id, [])
+        return RecipeShortSerializer(recipes, many=True,
+                                     context=self.context).data
 
     def validate(self, data):
         request = self.context.get('request')
@@ -197,6 +426,16 @@ class FollowSerializer(serializers.ModelSerializer):
         return data
 
 
+class BulkIdsSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1),
+                                allow_empty=False,
+                                max_length=MAX_BULK_IDS)
+
+    def validate_ids(self, ids):
+        # Repeated ids are answered once.
+        return list(dict.fromkeys(ids))
+
+
 class IngredientSerializer(serializers.ModelSerializer):
 
     class Meta:
@@ -205,11 +444,11 @@ class IngredientSerializer(serializers.ModelSerializer):
 
 
 class FavoriteSerializer(serializers.ModelSerializer):
-    id = serializers.IntegerField(source='recipe.id', read_only=True)
-    name = serializers.CharField(source='recipe.name', read_only=True)
-    cooking_time = serializers.CharField(source='recipe.cooking_time',
+    id = serializers.IntegerField(source='recipes.id', read_only=True)
+    name = serializers.CharField(source='recipes.name', read_only=True)
+    cooking_time = serializers.CharField(source='recipes.cooking_time',
                                          read_only=True)
-    image = serializers.CharField(source='recipe.image', read_only=True)
+    image = serializers.CharField(source='recipes.image', read_only=True)
 
     def validated(self, data):
         request = self.context.get('request')
@@ -228,11 +467,11 @@ class FavoriteSerializer(serializers.ModelSerializer):
 
 
 class ShoppingCartSerializer(serializers.ModelSerializer):
-    id = serializers.IntegerField(source='recipe.id', read_only=True)
-    name = serializers.CharField(source='recipe.name', read_only=True)
-    cooking_time = serializers.CharField(source='recipe.cooking_time',
+    id = serializers.IntegerField(source='recipes.id', read_only=True)
+    name = serializers.CharField(source='recipes.name', read_only=True)
+    cooking_time = serializers.CharField(source='recipes.cooking_time',
                                          read_only=True)
-    image = serializers.CharField(source='recipe.image', read_only=True)
+    image = serializers.CharField(source='recipes.image', read_only=True)
 
     def validated(self, data):
         request = self.context.get('request')
@@ -0,0 +1,139 @@
+from django.db import transaction
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete, pre_save)
+from django.dispatch import receiver
+from recipes.models import (Favorite, Follow, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingCart, Tag)
+from recipes.search import index_recipes, unindex_recipes
+from recipes.shopping import cart_users, shift_recipes
+from rest_framework.authtoken.models import Token
+from users.models import User
+
+from .authentication import token_cache
+from .cards import refresh_cards
+from .cache import bump, user_namespace
+from .pantry import pantry_index
+
+# The author fields that recipe responses and cards show.
+AUTHOR_FIELDS = ('email', 'username', 'first_name', 'last_name')
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+def ingredient_changed(sender, **kwargs):
+    bump('ingredients', 'recipes')
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def tag_changed(sender, **kwargs):
+    bump('tags', 'recipes')
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def recipe_changed(sender, **kwargs):
+    bump('recipes')
+
+
+@receiver(pre_save, sender=User)
+def author_changing(sender, instance, update_fields=None, **kwargs):
+    # Logins, passwords and counters leave the recipes as they are, and a
+    # new user has no recipes yet.
+    instance._author_changed = False
+    if instance._state.adding or update_fields is not None and not set(
+            update_fields) & set(AUTHOR_FIELDS):
+        return
+    saved = User.objects.filter(pk=instance.pk).values(*AUTHOR_FIELDS).first()
+    instance._author_changed = saved is not None and any(
+        saved[field] != getattr(instance, field) for field in AUTHOR_FIELDS)
+
+
+@receiver(post_save, sender=User)
+def author_changed(sender, instance, **kwargs):
+    if not instance.__dict__.pop('_author_changed', False):
+        return
+    bump('recipes')
+    refresh_cards(Recipe.objects.filter(author=instance).values_list(
+        'id', flat=True))
+
+
+@receiver(post_delete, sender=User)
+def author_deleted(sender, **kwargs):
+    bump('recipes')
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, **kwargs):
+    # A new password or is_active flag must reach the cached tokens.
+    user_id = instance.id
+    transaction.on_commit(lambda: token_cache.forget_user(user_id))
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    key = instance.key
+    transaction.on_commit(lambda: token_cache.forget(key))
+
+
+@receiver(post_save, sender=Favorite)
+@receiver(post_delete, sender=Favorite)
+@receiver(post_save, sender=ShoppingCart)
+@receiver(post_delete, sender=ShoppingCart)
+@receiver(post_save, sender=Follow)
+@receiver(post_delete, sender=Follow)
+def user_flags_changed(sender, instance, **kwargs):
+    bump(user_namespace(instance.user_id))
+
+
+@receiver(post_save, sender=Ingredient)
+def ingredient_renamed(sender, instance, created, **kwargs):
+    if not created:
+        recipe_ids = list(RecipeIngredient.objects.filter(
+            ingredient=instance).values_list('recipe_id', flat=True))
+        index_recipes(recipe_ids)
+        refresh_cards(recipe_ids)
+
+
+@receiver(pre_delete, sender=Ingredient)
+def ingredient_deleted(sender, instance, **kwargs):
+    # The links are gone by the time post_delete is sent.
+    recipe_ids = list(RecipeIngredient.objects.filter(
+        ingredient=instance).values_list('recipe_id', flat=True))
+    transaction.on_commit(lambda: index_recipes(recipe_ids))
+    transaction.on_commit(lambda: refresh_cards(recipe_ids))
+
+
+@receiver(post_save, sender=Tag)
+def tag_saved(sender, instance, created, **kwargs):
+    if not created:
+        refresh_cards(Recipe.objects.filter(tags=instance).values_list(
+            'id', flat=True))
+
+
+@receiver(pre_delete, sender=Tag)
+def tag_deleted(sender, instance, **kwargs):
+    recipe_ids = list(Recipe.objects.filter(tags=instance).values_list(
+        'id', flat=True))
+    transaction.on_commit(lambda: refresh_cards(recipe_ids))
+
+
+@receiver(pre_delete, sender=Recipe)
+def recipe_deleting(sender, instance, **kwargs):
+    # The cart rows go with the recipe, also when its author is deleted:
+    # take it off the buyers' shopping lists while they are still there.
+    shift_recipes(cart_users(instance.id), [instance.id], -1)
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_deleted(sender, instance, **kwargs):
+    unindex_recipes([instance.id])
+
+
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+def recipe_ingredient_changed(sender, instance, **kwargs):
+    pantry_index.schedule([instance.recipe_id])
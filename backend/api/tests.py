@@ -0,0 +1,504 @@
+import base64
+import io
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache, caches
+from django.core.files.base import ContentFile
+from django.db import OperationalError, transaction
+from django.test import RequestFactory, override_settings
+from django.urls import include, path
+from PIL import Image
+from recipes.images import store_variants
+from recipes.models import (Favorite, Follow, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingCart, ShoppingListItem,
+                            Tag)
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.routers import SimpleRouter
+from rest_framework.test import APITestCase, APITransactionTestCase
+from users.models import User
+
+from .asynchronous import ASGIHandler
+from .authentication import token_cache
+from .cache import get_version
+from .cards import CardRecipeSerializer, refresh_cards
+from .fields import Base64ImageField
+from .renderers import FastJSONRenderer
+from .serializers import LeanRecipeSerializer, RecipeSerializer
+from .throttling import heavy_requests
+from .views import RecipeViewSet
+
+# 1x1 transparent PNG.
+PNG = base64.b64decode(
+    'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAC'
+    'hwGA60e6kgAAAABJRU5ErkJggg==')
+
+# Views are marked as coroutines when they are built, so the async ones
+# get a URLconf of their own.
+with override_settings(ASYNC_VIEWS=True):
+    async_router = SimpleRouter()
+    async_router.register('recipes', RecipeViewSet)
+    urlpatterns = [path('api/', include(async_router.urls))]
+
+
+class RecipeTestCase(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [
+            User.objects.create_user(
+                email=f'user{index}@example.com', username=f'user{index}',
+                first_name='Имя', last_name='Фамилия', password='pass12345QQ')
+            for index in range(3)]
+        cls.user = cls.users[0]
+        cls.token = Token.objects.create(user=cls.user)
+        cls.tags = [Tag.objects.create(name=f'тег {index}',
+                                       color=f'#00000{index}',
+                                       slug=f'tag{index}')
+                    for index in range(3)]
+        cls.ingredients = [
+            Ingredient.objects.create(name=f'продукт {index}',
+                                      measurement_unit='г')
+            for index in range(60)]
+
+    def setUp(self):
+        cache.clear()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def create_recipes(self, count):
+        recipes = []
+        for index in range(count):
+            recipe = Recipe.objects.create(
+                author=self.users[index % len(self.users)],
+                name=f'рецепт {index}', text='текст', cooking_time=5)
+            recipe.tags.set(self.tags[:2])
+            RecipeIngredient.objects.bulk_create(
+                RecipeIngredient(recipe=recipe, ingredient=ingredient,
+                                 amount=index + 1)
+                for ingredient in self.ingredients[index:index + 5])
+            recipes.append(recipe)
+        return recipes
+
+    def use_temporary_media(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        media_root = override_settings(MEDIA_ROOT=media, IMAGE_WORKERS=0)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+
+
+class RecipeQueriesTest(RecipeTestCase):
+    """List and retrieve must not issue a query per recipe or relation."""
+
+    def setUp(self):
+        super().setUp()
+        recipes = self.create_recipes(12)
+        Favorite.objects.create(user=self.user, recipes=recipes[1])
+        ShoppingCart.objects.create(user=self.user, recipes=recipes[2])
+        Follow.objects.create(user=self.user, author=self.users[1])
+        # Authenticate once so the token lookup is not counted below.
+        self.client.get('/api/tags/')
+
+    def test_list_query_count_does_not_depend_on_page_size(self):
+        # Count, page, authors, tags and ingredients.
+        for limit in (2, 12):
+            with self.assertNumQueries(5):
+                response = self.client.get(f'/api/recipes/?limit={limit}')
+            self.assertEqual(len(response.json()['results']), limit)
+
+    def test_list_flags(self):
+        response = self.client.get('/api/recipes/?limit=12')
+        rows = {row['id']: row for row in response.json()['results']}
+        favorite = Favorite.objects.get(user=self.user).recipes_id
+        in_cart = ShoppingCart.objects.get(user=self.user).recipes_id
+        self.assertEqual(
+            [pk for pk, row in rows.items() if row['is_favorited']],
+            [favorite])
+        self.assertEqual(
+            [pk for pk, row in rows.items() if row['is_in_shopping_cart']],
+            [in_cart])
+        self.assertTrue(all(row['author']['is_subscribed']
+                            == (row['author']['id'] == self.users[1].id)
+                            for row in rows.values()))
+
+    def test_flag_filters_accept_numbers(self):
+        for flag in ('is_favorited', 'is_in_shopping_cart'):
+            for value in ('1', 'true'):
+                response = self.client.get(f'/api/recipes/?{flag}={value}')
+                self.assertEqual(response.json()['count'], 1)
+            for value in ('0', 'false'):
+                response = self.client.get(f'/api/recipes/?{flag}={value}')
+                self.assertEqual(response.json()['count'], 12)
+
+    def test_retrieve_query_count(self):
+        recipe = Recipe.objects.order_by('id').first()
+        with self.assertNumQueries(4):
+            response = self.client.get(f'/api/recipes/{recipe.id}/')
+        self.assertEqual(len(response.json()['ingredients']), 5)
+        self.assertEqual(len(response.json()['tags']), 2)
+
+
+class RecipeCacheTest(RecipeTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.use_temporary_media()
+        self.recipe = self.create_recipes(1)[0]
+
+    def test_new_variants_reach_cached_detail(self):
+        self.recipe.image.save('photo.png', ContentFile(PNG))
+        path = f'/api/recipes/{self.recipe.id}/'
+        self.assertEqual(self.client.get(path).json()['image_variants'], {})
+        store_variants(self.recipe.id, self.recipe.image.name)
+        variants = self.client.get(path).json()['image_variants']
+        self.assertEqual(set(variants), {'card', 'detail'})
+
+    def test_only_author_fields_retire_cached_recipes(self):
+        version = get_version('recipes')
+        User.objects.create_user(email='new@example.com', username='new',
+                                 first_name='Имя', last_name='Фамилия',
+                                 password='pass12345QQ')
+        self.client.post('/api/auth/token/login/', {
+            'email': 'new@example.com', 'password': 'pass12345QQ'})
+        self.user.set_password('pass67890QQ')
+        self.user.save()
+        self.assertEqual(get_version('recipes'), version)
+        self.user.first_name = 'Другое'
+        self.user.save()
+        self.assertNotEqual(get_version('recipes'), version)
+
+
+class SerializerContractTest(RecipeTestCase):
+    """
+    Collections rendered from rows, with or without stored cards, are the
+    same bytes as RecipeSerializer and JSONRenderer give.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.use_temporary_media()
+        recipes = self.create_recipes(6)
+        recipes[0].image.save('photo.png', ContentFile(PNG))
+        Favorite.objects.create(user=self.user, recipes=recipes[1])
+        ShoppingCart.objects.create(user=self.user, recipes=recipes[2])
+        Follow.objects.create(user=self.user, author=self.users[1])
+        # The last recipes are left without a card.
+        refresh_cards([recipe.id for recipe in recipes[:4]])
+
+    def view(self, user, action):
+        request = RequestFactory().get('/api/recipes/')
+        request.user = user
+        return RecipeViewSet(request=request, action=action, kwargs={},
+                             format_kwarg=None)
+
+    def assert_same_json(self, user):
+        context = {'request': self.view(user, 'list').request}
+        recipes = self.view(user, 'retrieve').get_queryset().order_by('-id')
+        expected = JSONRenderer().render(
+            RecipeSerializer(recipes, many=True, context=context).data)
+        for action, serializer in (('pantry', LeanRecipeSerializer),
+                                   ('list', CardRecipeSerializer)):
+            rows = list(self.view(user, action).get_queryset()
+                        .order_by('-id'))
+            with self.subTest(serializer=serializer.__name__):
+                self.assertEqual(FastJSONRenderer().render(
+                    serializer(rows, context=context).data), expected)
+
+    def test_anonymous(self):
+        self.assert_same_json(AnonymousUser())
+
+    def test_flags_set_and_unset(self):
+        data = RecipeSerializer(
+            Recipe.objects.order_by('-id'), many=True,
+            context={'request': self.view(self.user, 'list').request}).data
+        for flag in ('is_favorited', 'is_in_shopping_cart'):
+            self.assertEqual({row[flag] for row in data}, {True, False})
+        self.assertEqual({row['author']['is_subscribed'] for row in data},
+                         {True, False})
+        self.assertEqual({row['image'] is None for row in data},
+                         {True, False})
+        self.assert_same_json(self.user)
+
+    def test_user_without_flags(self):
+        self.assert_same_json(self.users[2])
+
+
+class Base64ImageFieldTest(RecipeTestCase):
+
+    def decode(self, data):
+        return Base64ImageField().run_validation(data)
+
+    def test_wrapped_base64(self):
+        wrapped = base64.encodebytes(PNG).decode()
+        self.assertIn('\n', wrapped)
+        image = self.decode('data:image/png;base64,' + wrapped)
+        self.assertTrue(image.name.endswith('.png'))
+        self.assertEqual(image.read(), PNG)
+
+    def test_decompression_bomb_is_a_validation_error(self):
+        buffer = io.BytesIO()
+        Image.new('L', (4, 4)).save(buffer, 'PNG')
+        data = base64.b64encode(buffer.getvalue()).decode()
+        with mock.patch.object(Image, 'MAX_IMAGE_PIXELS', 1):
+            with self.assertRaises(ValidationError):
+                self.decode(data)
+
+
+class RecipeWriteQueriesTest(RecipeTestCase):
+    """Ingredients and tags are checked and written in bulk."""
+
+    def setUp(self):
+        super().setUp()
+        self.use_temporary_media()
+        # Authenticate once so the token lookup is not counted below.
+        self.client.get('/api/tags/')
+
+    def form(self, ingredients, amount=5):
+        return {
+            'ingredients': [{'id': ingredient.id, 'amount': amount}
+                            for ingredient in ingredients],
+            'tags': [tag.id for tag in self.tags[:2]],
+            'image': 'data:image/png;base64,'
+                     + base64.b64encode(PNG).decode(),
+            'name': 'рецепт',
+            'text': 'текст',
+            'cooking_time': 5,
+        }
+
+    def test_create_query_count_does_not_depend_on_ingredients(self):
+        for count in (5, 50):
+            with self.assertNumQueries(21):
+                response = self.client.post(
+                    '/api/recipes/', self.form(self.ingredients[:count]),
+                    format='json')
+            self.assertEqual(response.status_code, 201, response.content)
+            self.assertEqual(len(response.json()['ingredients']), count)
+
+    def test_update_query_count_with_50_ingredients(self):
+        response = self.client.post(
+            '/api/recipes/', self.form(self.ingredients[:50]), format='json')
+        path = f'/api/recipes/{response.json()["id"]}/'
+        # New amounts only, then half of the ingredients replaced too:
+        # one bulk update, or one delete and one insert, whatever the
+        # number of rows.
+        for ingredients, queries in ((self.ingredients[:50], 23),
+                                     (self.ingredients[25:], 25)):
+            with self.assertNumQueries(queries):
+                response = self.client.put(
+                    path, self.form(ingredients, amount=7), format='json')
+            self.assertEqual(response.status_code, 200, response.content)
+        stored = RecipeIngredient.objects.filter(
+            recipe_id=response.json()['id'])
+        self.assertEqual(
+            sorted(stored.values_list('ingredient_id', 'amount')),
+            [(ingredient.id, 7) for ingredient in self.ingredients[25:]])
+
+
+@override_settings(TOKEN_CACHE_BACKEND='default', TOKEN_CACHE_TTL=7)
+class TokenCacheTest(RecipeTestCase):
+
+    def test_shared_entries_expire_with_the_ttl(self):
+        with mock.patch.object(caches['default'], 'set') as shared_set:
+            token_cache.set(self.token.key, self.user, self.token)
+        self.assertEqual(shared_set.call_args.kwargs['timeout'], 7)
+
+    def test_local_copy_expires_with_the_shared_entry(self):
+        self.addCleanup(token_cache.clear)
+        token_cache.set(self.token.key, self.user, self.token)
+        token_cache.clear()
+        # Another worker finds the entry 5 of its 7 seconds later.
+        with mock.patch('api.authentication.time.time',
+                        return_value=time.time() + 5):
+            self.assertIsNotNone(token_cache.get(self.token.key))
+        with mock.patch('api.authentication.time.monotonic',
+                        return_value=time.monotonic() + 3):
+            self.assertIsNone(token_cache._get_local(self.token.key))
+
+
+class BulkToggleTest(RecipeTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.recipes = self.create_recipes(3)
+
+    def test_only_new_rows_are_counted(self):
+        first, second, third = (recipe.id for recipe in self.recipes)
+        self.client.post(f'/api/recipes/{first}/favorite/')
+        response = self.client.post('/api/recipes/favorite/',
+                                    {'ids': [first, second, 999]},
+                                    format='json')
+        self.assertEqual(response.json()['results'], [
+            {'id': first, 'status': 'exists'},
+            {'id': second, 'status': 'created'},
+            {'id': 999, 'status': 'not_found'}])
+        self.assertEqual(
+            dict(Recipe.objects.values_list('id', 'favorites_count')),
+            {first: 1, second: 1, third: 0})
+
+    def test_single_toggles_refuse_duplicates(self):
+        recipe = self.recipes[0]
+        self.client.post('/api/recipes/favorite/', {'ids': [recipe.id]},
+                         format='json')
+        response = self.client.post(f'/api/recipes/{recipe.id}/favorite/')
+        self.assertEqual(response.status_code, 400)
+        author = self.users[1]
+        self.client.post('/api/users/subscribe/', {'ids': [author.id]},
+                         format='json')
+        response = self.client.post(f'/api/users/{author.id}/subscribe/')
+        self.assertEqual(response.status_code, 400)
+        author.refresh_from_db()
+        recipe.refresh_from_db()
+        self.assertEqual((recipe.favorites_count, author.followers_count),
+                         (1, 1))
+
+
+@override_settings(HEAVY_REQUESTS_PER_WORKER=1)
+class HeavyRequestTest(RecipeTestCase):
+
+    def export(self):
+        return self.client.get('/api/recipes/download_shopping_cart/')
+
+    def test_slot_is_released_after_an_unhandled_error(self):
+        self.client.raise_request_exception = False
+        with mock.patch('api.views.StreamingHttpResponse',
+                        side_effect=OperationalError('pool exhausted')):
+            self.assertEqual(self.export().status_code, 500)
+        self.assertEqual(heavy_requests.in_flight, 0)
+        response = self.export()
+        response.close()
+        self.assertEqual(response.status_code, 200)
+
+    def test_streamed_response_holds_the_slot_until_closed(self):
+        response = self.export()
+        self.assertEqual(heavy_requests.in_flight, 1)
+        self.assertEqual(self.export().status_code, 503)
+        response.close()
+        self.assertEqual(heavy_requests.in_flight, 0)
+
+
+class CommitOrderTest(APITransactionTestCase):
+    """A response cached while a write is uncommitted must not outlive it."""
+
+    def setUp(self):
+        cache.clear()
+        author = User.objects.create_user(
+            email='author@example.com', username='author', first_name='Имя',
+            last_name='Фамилия', password='pass12345QQ')
+        self.recipe = Recipe.objects.create(author=author, name='старое',
+                                            text='текст', cooking_time=5)
+
+    def name(self):
+        response = self.client.get(f'/api/recipes/{self.recipe.id}/')
+        return response.json()['name']
+
+    def test_detail_cached_between_write_and_commit(self):
+        self.assertEqual(self.name(), 'старое')
+        with transaction.atomic():
+            self.recipe.name = 'новое'
+            self.recipe.save()
+            # Another connection still reads the committed row: play it
+            # back in a savepoint, as update() sends no signal.
+            savepoint = transaction.savepoint()
+            Recipe.objects.filter(id=self.recipe.id).update(name='старое')
+            self.assertEqual(self.name(), 'старое')
+            transaction.savepoint_rollback(savepoint)
+        self.assertEqual(self.name(), 'новое')
+
+
+class ImageReplaceTest(APITransactionTestCase):
+    """A replaced image leaves no files behind once the new one is ready."""
+
+    def setUp(self):
+        cache.clear()
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        media_root = override_settings(MEDIA_ROOT=self.media, IMAGE_WORKERS=0)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        user = User.objects.create_user(
+            email='author@example.com', username='author', first_name='Имя',
+            last_name='Фамилия', password='pass12345QQ')
+        self.client.force_authenticate(user)
+        self.tag = Tag.objects.create(name='тег', color='#000000', slug='tag')
+        self.ingredient = Ingredient.objects.create(name='продукт',
+                                                    measurement_unit='г')
+
+    def files(self):
+        return {os.path.relpath(os.path.join(root, name), self.media)
+                .replace(os.sep, '/')
+                for root, _, names in os.walk(self.media) for name in names}
+
+    def image(self):
+        return {'image': 'data:image/png;base64,'
+                         + base64.b64encode(PNG).decode()}
+
+    def test_old_image_and_variants_deleted(self):
+        response = self.client.post('/api/recipes/', {
+            'ingredients': [{'id': self.ingredient.id, 'amount': 5}],
+            'tags': [self.tag.id], 'name': 'рецепт', 'text': 'текст',
+            'cooking_time': 5, **self.image()}, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        recipe = Recipe.objects.get()
+        first = recipe.image.name
+        self.assertEqual(len(self.files()), 5)
+        response = self.client.patch(f'/api/recipes/{recipe.id}/',
+                                     self.image(), format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        recipe.refresh_from_db()
+        self.assertNotEqual(recipe.image.name, first)
+        self.assertEqual(self.files(), {
+            recipe.image.name, *(path for formats in
+                                 recipe.image_variants.values()
+                                 for path in formats.values())})
+
+
+@override_settings(ROOT_URLCONF='api.tests', ASYNC_VIEWS=True)
+class AsgiExportTest(APITransactionTestCase):
+    """Under ASGI the export is sent as it is read, a batch at a time."""
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(
+            email='buyer@example.com', username='buyer', first_name='Имя',
+            last_name='Фамилия', password='pass12345QQ')
+        self.token = Token.objects.create(user=user)
+        Ingredient.objects.bulk_create(
+            Ingredient(name=f'продукт {index:02}', measurement_unit='г')
+            for index in range(50))
+        ShoppingListItem.objects.bulk_create(
+            ShoppingListItem(user=user, ingredient_id=pk, total=5,
+                             recipes_count=1)
+            for pk in Ingredient.objects.values_list('id', flat=True))
+
+    async def export(self):
+        communicator = ApplicationCommunicator(ASGIHandler(), {
+            'type': 'http', 'method': 'GET',
+            'path': '/api/recipes/download_shopping_cart/',
+            'query_string': b'format=txt',
+            'headers': [(b'authorization',
+                         f'Token {self.token.key}'.encode())]})
+        await communicator.send_input({'type': 'http.request'})
+        messages = [await communicator.receive_output()]
+        while messages[-1]['type'] == 'http.response.start' or messages[
+                -1].get('more_body'):
+            messages.append(await communicator.receive_output())
+        return messages
+
+    def test_export_sent_in_batches(self):
+        with mock.patch('api.asynchronous.STREAM_BATCH', 10):
+            start, *body = async_to_sync(self.export)()
+        self.assertEqual(start['status'], 200)
+        # The title and 50 rows in batches of 10, then the closing message.
+        chunks = [message.get('body', b'') for message in body]
+        self.assertEqual([bool(chunk) for chunk in chunks],
+                         [True] * 6 + [False])
+        text = b''.join(chunks).decode()
+        self.assertEqual(text.count(': 5 г'), 50)
@@ -0,0 +1,199 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+BUCKET_KEY = 'throttle:{}:{}'
+REJECTED_KEY = 'rejected:{}:{}'
+REJECTION_REASONS = ('throttled', 'overloaded')
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """'10/m' -> (10, 60): a bucket of 10 requests, refilled in a minute."""
+    number, period = rate.split('/')
+    return int(number), PERIODS[period[0]]
+
+
+def count_rejection(reason, scope):
+    key = REJECTED_KEY.format(reason, scope)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, timeout=None)
+        cache.incr(key)
+
+
+def rejection_counts():
+    """Rejected requests of every reason and scope, over all workers."""
+    scopes = sorted(api_settings.DEFAULT_THROTTLE_RATES)
+    counts = cache.get_many([REJECTED_KEY.format(reason, scope)
+                             for reason in REJECTION_REASONS
+                             for scope in scopes])
+    return {reason: {scope: counts.get(REJECTED_KEY.format(reason, scope), 0)
+                     for scope in scopes}
+            for reason in REJECTION_REASONS}
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Throttles the actions in the throttle_scopes of the view with a token
+    bucket per scope and client, kept in the default cache: a client may
+    send as many requests at once as the rate allows per period, then as
+    fast as the bucket refills. Buckets are read and written without a
+    lock, so workers racing on one client may let a request or two more
+    through. Scopes without a rate are not throttled.
+    """
+
+    def get_client(self, request):
+        raise NotImplementedError
+
+    def allow_request(self, request, view):
+        scope = getattr(view, 'throttle_scopes', {}).get(view.action)
+        rate = api_settings.DEFAULT_THROTTLE_RATES.get(scope)
+        if not rate:
+            return True
+        capacity, period = parse_rate(rate)
+        key = BUCKET_KEY.format(scope, self.get_client(request))
+        now = time.time()
+        tokens, updated = cache.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * capacity / period)
+        if tokens < 1:
+            self.wait_time = (1 - tokens) * period / capacity
+            count_rejection('throttled', scope)
+            return False
+        # An untouched bucket is full again after a period.
+        cache.set(key, (tokens - 1, now), period)
+        return True
+
+    def wait(self):
+        return self.wait_time
+
+
+class UserBucketThrottle(TokenBucketThrottle):
+    """Per user, and per IP address for anonymous requests."""
+
+    def get_client(self, request):
+        if request.user.is_authenticated:
+            return f'user:{request.user.id}'
+        return f'ip:{self.get_ident(request)}'
+
+
+class IPBucketThrottle(TokenBucketThrottle):
+
+    def get_client(self, request):
+        return f'ip:{self.get_ident(request)}'
+
+
+class Overloaded(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Сервер занят, повторите запрос позже.'
+    default_code = 'overloaded'
+
+    def __init__(self, wait):
+        super().__init__()
+        # Sent as Retry-After by the DRF exception handler.
+        self.wait = wait
+
+
+class ConcurrencyLimiter:
+    """
+    Counts the heavy requests running in this process and refuses more
+    than HEAVY_REQUESTS_PER_WORKER, 0 being no limit.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_flight = 0
+
+    def acquire(self):
+        limit = settings.HEAVY_REQUESTS_PER_WORKER
+        with self._lock:
+            if limit and self.in_flight >= limit:
+                return None
+            self.in_flight += 1
+        return Slot(self)
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+class Slot:
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.limiter.release()
+
+
+heavy_requests = ConcurrencyLimiter()
+
+
+class ClosingContent:
+    """Streaming content that releases the slot with the response."""
+
+    def __init__(self, content, slot):
+        self.content = content
+        self.slot = slot
+
+    def __iter__(self):
+        return iter(self.content)
+
+    def close(self):
+        self.slot.release()
+
+
+class HeavyActionMixin:
+    """
+    The actions in throttle_scopes are expensive: they go through the
+    token buckets of throttle_classes, answered by 429 and Retry-After,
+    and no more than HEAVY_REQUESTS_PER_WORKER of them run at once in a
+    worker, the others being shed with 503 and Retry-After. The slot of
+    a streamed response is held until the stream is closed, any other is
+    released with the response or the unhandled exception.
+    """
+    throttle_scopes = {}
+    heavy_slot = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        scope = self.throttle_scopes.get(self.action)
+        if scope is None:
+            return
+        self.heavy_slot = heavy_requests.acquire()
+        if self.heavy_slot is None:
+            count_rejection('overloaded', scope)
+            raise Overloaded(settings.HEAVY_RETRY_AFTER)
+
+    def handle_exception(self, exc):
+        try:
+            return super().handle_exception(exc)
+        except Exception:
+            # Re-raised for a 500, so finalize_response() is never called.
+            self.release_slot()
+            raise
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(
+            request, response, *args, **kwargs)
+        if self.heavy_slot is not None and response.streaming:
+            response.streaming_content = ClosingContent(
+                response.streaming_content, self.heavy_slot)
+            self.heavy_slot = None
+        self.release_slot()
+        return response
+
+    def release_slot(self):
+        slot, self.heavy_slot = self.heavy_slot, None
+        if slot is not None:
+            slot.release()
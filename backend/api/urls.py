@@ -2,18 +2,21 @@ from django.urls import include, path
 from djoser.views import TokenCreateView, TokenDestroyView
 from rest_framework.routers import SimpleRouter
 
-from .views import (FavoriteViewSet, FollowChangeViewSet, FollowViewSet,
-                    IngredientViewSet, ModUserViewSet, RecipeViewSet,
+from .views import (FavoriteBulkViewSet, FavoriteViewSet,
+                    FollowBulkViewSet, FollowChangeViewSet, FollowViewSet,
+                    IngredientViewSet, MetricsView, ModUserViewSet,
+                    RecipeViewSet, ShoppingCartBulkViewSet,
                     ShoppingCartViewSet, TagViewSet)
 
 router_v1 = SimpleRouter()
 router_v1.register('tags', TagViewSet)
-router_v1.register('users', ModUserViewSet)
-router_v1.register('recipes', RecipeViewSet)
-router_v1.register('ingredients', IngredientViewSet)
+# Before users, whose detail route would take "subscriptions" for an id.
 router_v1.register('users/subscriptions',
                    FollowViewSet,
                    basename='subscriptions')
+router_v1.register('users', ModUserViewSet)
+router_v1.register('recipes', RecipeViewSet)
+router_v1.register('ingredients', IngredientViewSet)
 
 
 urlpatterns = [
@@ -33,5 +36,14 @@ urlpatterns = [
          FavoriteViewSet.as_view({'post': 'create', 'delete': 'destroy'})),
     path('users/<int:author_id>/subscribe/',
          FollowChangeViewSet.as_view({'post': 'create', 'delete': 'destroy'})),
+    # Batches of ids, ahead of the router that would take them for a pk.
+    path('recipes/shopping_cart/',
+         ShoppingCartBulkViewSet.as_view({'post': 'create',
+                                          'delete': 'destroy'})),
+    path('recipes/favorite/',
+         FavoriteBulkViewSet.as_view({'post': 'create', 'delete': 'destroy'})),
+    path('users/subscribe/',
+         FollowBulkViewSet.as_view({'post': 'create', 'delete': 'destroy'})),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
     path('', include(router_v1.urls))
 ]
@@ -1,86 +1,249 @@
+import asyncio
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import Count, Exists, OuterRef, Sum
-from django.http import HttpResponse
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Prefetch
+from django.http import (HttpResponse, HttpResponseNotModified,
+                         StreamingHttpResponse)
 from django.shortcuts import get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
 from djoser.views import UserViewSet
 from recipes.models import (Favorite, Follow, Ingredient, Recipe,
-                            RecipeIngredient, ShoppingCart, Tag)
-from rest_framework import filters, viewsets
+                            RecipeIngredient, ShoppingCart, ShoppingListItem,
+                            SimilarRecipe, Tag)
+from recipes.shopping import shift_recipes
+from rest_framework import status, viewsets
+from rest_framework.exceptions import ValidationError
 from rest_framework.mixins import ListModelMixin
-from rest_framework.permissions import SAFE_METHODS, AllowAny, IsAuthenticated
+from rest_framework.parsers import JSONParser, MultiPartParser
+from rest_framework.permissions import (SAFE_METHODS, AllowAny, IsAdminUser,
+                                        IsAuthenticated)
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework.viewsets import GenericViewSet
 from rest_framework.decorators import action
 
+from .asynchronous import AsyncReadMixin, database_sync_to_async
+from .autocomplete import ingredient_index
+from .cards import CardRecipeSerializer, refresh_cards
+from .cache import CachedResponseMixin
+from .exports import SHOPPING_LIST_FORMATS
 from .filters import FilterRecipe
-from .mixins import FavoritMixin, FollowMixin, ListRetriveViewSet
-from .pagination import CustomPaginator
+from .mixins import (BulkToggleViewSet, FavoritMixin, FollowMixin,
+                     ListRetriveViewSet, ReplicaReadMixin, lock_users)
+from .pagination import (MAX_PAGE_SIZE, CustomPaginator, KeysetPaginator,
+                         OptInCursorPaginator)
+from .pantry import pantry_index
 from .permissions import IsAdminOrReadOnly
-from .serializers import (FavoriteSerializer, FollowSerializer,
-                          IngredientSerializer, ModUserSerializer,
+from .previews import recipe_previews
+from .renderers import CSVRenderer, TextRenderer
+from .serializers import (CARD_RECIPE_FIELDS, LEAN_RECIPE_FIELDS,
+                          FavoriteSerializer,
+                          FollowSerializer, IngredientSerializer,
+                          LeanRecipeSerializer, ModUserSerializer,
                           RecipeSerializer, RecipeSerializerCreate,
                           ShoppingCartSerializer, TagSerializer)
+from .throttling import (HeavyActionMixin, IPBucketThrottle,
+                         UserBucketThrottle, rejection_counts)
 
 User = get_user_model()
 
+SHOPPING_LIST_CHUNK = 500
+
 
-class TagViewSet(ListRetriveViewSet):
+class TagViewSet(CachedResponseMixin, AsyncReadMixin, ListRetriveViewSet):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     permission_classes = (AllowAny,)
     pagination_class = None
+    cache_namespaces = ('tags',)
 
 
-class IngredientViewSet(ListRetriveViewSet):
+class IngredientViewSet(CachedResponseMixin, AsyncReadMixin,
+                        ListRetriveViewSet):
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     permission_classes = (AllowAny,)
-    filter_backend = (filters.SearchFilter,)
     pagination_class = None
-    search_fields = ('^name',)
+    cache_namespaces = ('ingredients',)
+
+    def list(self, request, *args, **kwargs):
+        body, etag = ingredient_index.search(
+            request.query_params.get('name', ''),
+            settings.INGREDIENT_SEARCH_LIMIT)
+        etag = f'"{etag}"'
+        if etag in request.headers.get('If-None-Match', ''):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(body, content_type='application/json')
+        response['ETag'] = etag
+        return response
 
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(ReplicaReadMixin, HeavyActionMixin, CachedResponseMixin,
+                    AsyncReadMixin, viewsets.ModelViewSet):
     queryset = Recipe.objects.all()
     serializer_class = RecipeSerializer
     permission_classes = (IsAdminOrReadOnly,)
-    pagination_class = CustomPaginator
+    pagination_class = OptInCursorPaginator
     filter_backends = (DjangoFilterBackend,)
     filterset_class = FilterRecipe
+    # Images come either base64-encoded in JSON or as a multipart file part.
+    parser_classes = (JSONParser, MultiPartParser)
+    cache_namespaces = ('recipes',)
+    cache_per_user = True
+    cached_actions = ('retrieve',)
+    # Collections are rendered by LeanRecipeSerializer from .values() rows.
+    lean_actions = ('list', 'feed', 'pantry', 'similar')
+    # Those that leave the items as they are use the stored cards.
+    card_actions = ('list', 'feed')
+    throttle_classes = (UserBucketThrottle,)
+    throttle_scopes = {'download_shopping_cart': 'export',
+                       'create': 'upload', 'update': 'upload',
+                       'partial_update': 'upload'}
+
+    def get_queryset(self):
+        user_id = self.request.user.id
+        recipes = Recipe.objects.annotate(
+            is_favorited=Exists(Favorite.objects.filter(
+                user_id=user_id, recipes=OuterRef('id'))),
+            is_in_shopping_cart=Exists(ShoppingCart.objects.filter(
+                user_id=user_id, recipes=OuterRef('id'))))
+        if self.action in self.card_actions:
+            subscribed = Follow.objects.filter(
+                user_id=user_id, author_id=OuterRef('author_id'))
+            return recipes.annotate(
+                is_subscribed=Exists(subscribed)).values(*CARD_RECIPE_FIELDS)
+        if self.action in self.lean_actions:
+            return recipes.values(*LEAN_RECIPE_FIELDS)
+        authors = User.objects.annotate(
+            is_subscribed=Exists(
+                Follow.objects.filter(
+                    user_id=user_id, author__id=OuterRef('id')
+                )
+            )
+        )
+        ingredients = RecipeIngredient.objects.select_related('ingredient')
+        return recipes.prefetch_related(
+            Prefetch('author', queryset=authors),
+            'tags',
+            Prefetch('recipe_ingredient', queryset=ingredients))
 
     def get_serializer_class(self):
+        if self.action in self.card_actions:
+            return CardRecipeSerializer
+        if self.action in self.lean_actions:
+            return LeanRecipeSerializer
         if self.request.method in SAFE_METHODS:
             return RecipeSerializer
         return RecipeSerializerCreate
 
+    @transaction.atomic
     def perform_create(self, serializer):
-        serializer.save(author=self.request.user)
+        recipe = serializer.save(author=self.request.user)
+        refresh_cards([recipe.id])
+
+    @transaction.atomic
+    def perform_update(self, serializer):
+        refresh_cards([serializer.save().id])
+
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        instance.delete()
+        User.objects.filter(id=instance.author_id).update(
+            recipes_count=F('recipes_count') - 1)
+
+    @action(detail=False, permission_classes=[IsAuthenticated],
+            pagination_class=KeysetPaginator)
+    def feed(self, request):
+        """Latest recipes of every followed author, newest first."""
+        queryset = self.filter_queryset(self.get_queryset()).filter(
+            author__following__user=request.user)
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(detail=False)
+    def pantry(self, request):
+        """
+        Recipes that can be cooked from the ingredients in
+        ?ingredients=1,2,3, the fewest missing ingredients first.
+        """
+        try:
+            ingredient_ids = {
+                int(value) for values in
+                request.query_params.getlist('ingredients')
+                for value in values.split(',') if value}
+            limit = int(request.query_params.get(
+                'limit', CustomPaginator.page_size))
+        except ValueError:
+            raise ValidationError({'ingredients': [
+                'Нужен список id ингредиентов через запятую']})
+        if not ingredient_ids:
+            raise ValidationError(
+                {'ingredients': ['Нужен хотя бы один ингредиент']})
+        ranked = pantry_index.rank(
+            ingredient_ids, min(max(limit, 1), MAX_PAGE_SIZE))
+        recipes = {row['id']: row for row in self.get_queryset().filter(
+            id__in=[recipe_id for recipe_id, _, _ in ranked])}
+        # The index may be a moment ahead of or behind the database.
+        ranked = [row for row in ranked if row[0] in recipes]
+        serializer = self.get_serializer(
+            [recipes[recipe_id] for recipe_id, _, _ in ranked], many=True)
+        data = serializer.data
+        for item, (_, missing, jaccard) in zip(data, ranked):
+            item['missing_ingredients'] = missing
+            item['jaccard'] = round(jaccard, 3)
+        return Response(data)
 
-    @action(detail=False, permission_classes=[IsAuthenticated])
+    @action(detail=True)
+    def similar(self, request, pk=None):
+        """
+        Recipes most alike in ingredients and tags, as precomputed by the
+        rank_recipes command, the most similar first.
+        """
+        recipe = get_object_or_404(Recipe.objects.only('id'), pk=pk)
+        scores = dict(SimilarRecipe.objects.filter(recipe=recipe)
+                      .values_list('similar_id', 'score'))
+        recipes = self.get_queryset().filter(id__in=scores)
+        ranked = sorted(recipes,
+                        key=lambda item: (-scores[item['id']], -item['id']))
+        serializer = self.get_serializer(ranked, many=True)
+        data = serializer.data
+        for item in data:
+            item['similarity'] = round(scores[item['id']], 3)
+        return Response(data)
+
+    @action(detail=False, permission_classes=[IsAuthenticated],
+            renderer_classes=[TextRenderer, CSVRenderer, JSONRenderer])
     def download_shopping_cart(self, request):
-        ingredients = RecipeIngredient.objects.filter(
-            recipe__carts__user=request.user).values(
-            'ingredient__name',
-            'ingredient__measurement_unit').annotate(total=Sum('amount'))
-        shopping_list = 'Список покупок:\n\n'
-        for number, ingredient in enumerate(ingredients, start=1):
-            shopping_list += (
-                f'{ingredient["ingredient__name"]}: '
-                f'{ingredient["total"]} '
-                f'{ingredient["ingredient__measurement_unit"]}\n')
-
-        cart = 'shopping-list.txt'
-        response = HttpResponse(shopping_list, content_type='text/plain')
+        export_format = request.accepted_renderer.format
+        content_type, export = SHOPPING_LIST_FORMATS[export_format]
+        ingredients = (ShoppingListItem.objects
+                       .filter(user=request.user)
+                       .values('ingredient__name',
+                               'ingredient__measurement_unit', 'total')
+                       .order_by('ingredient__name'))
+
+        cart = f'shopping-list.{export_format}'
+        response = StreamingHttpResponse(
+            export(ingredients.iterator(chunk_size=SHOPPING_LIST_CHUNK)),
+            content_type=content_type)
         response['Content-Disposition'] = (f'attachment;'
                                            f'filename={cart}')
         return response
 
 
-class ModUserViewSet(UserViewSet):
+class ModUserViewSet(ReplicaReadMixin, HeavyActionMixin, UserViewSet):
     queryset = User.objects.all()
     serializers = ModUserSerializer
     permission_classes = [AllowAny]
     pagination_class = CustomPaginator
+    # Hashing the password is what makes a registration expensive.
+    throttle_classes = (IPBucketThrottle,)
+    throttle_scopes = {'create': 'register'}
 
     def get_queryset(self):
         user_id = self.request.user.id
@@ -99,25 +262,95 @@ class ShoppingCartViewSet(FavoritMixin):
     queryset = ShoppingCart.objects.all()
     pagination_class = None
 
+    def change_counter(self, recipe, delta):
+        # The cart keeps the shopping list totals rather than a counter.
+        shift_recipes([self.request.user.id], [recipe.id], delta)
+
 
 class FavoriteViewSet(FavoritMixin):
     model = Favorite
     queryset = Favorite.objects.all()
     serializer_class = FavoriteSerializer
     pagination_class = None
+    counter_field = 'favorites_count'
+
+
+class ShoppingCartBulkViewSet(BulkToggleViewSet):
+    model = ShoppingCart
+
+    def change_counters(self, recipe_ids, delta):
+        shift_recipes([self.request.user.id], recipe_ids, delta)
 
 
-class FollowViewSet(GenericViewSet, ListModelMixin):
+class FavoriteBulkViewSet(BulkToggleViewSet):
+    model = Favorite
+    counter_field = 'favorites_count'
+
+
+class FollowBulkViewSet(BulkToggleViewSet):
+    model = Follow
+    target_model = User
+    target_field = 'author'
+    counter_field = 'followers_count'
+
+    def locked_users(self, author_ids):
+        # The followers_count of the authors changes too.
+        return [self.request.user.id, *author_ids]
+
+    def refused(self, author_id):
+        return author_id == self.request.user.id
+
+
+class FollowViewSet(ReplicaReadMixin, AsyncReadMixin, GenericViewSet,
+                    ListModelMixin):
     model = Follow
     serializer_class = FollowSerializer
     permission_classes = (IsAuthenticated,)
+    pagination_class = OptInCursorPaginator
 
     def get_queryset(self):
         user_id = self.request.user.id
-        return (self.request.user.follower.all()
-                .annotate(recipes_count=Count('author__recipes'))
+        return (self.request.user.follower.select_related('author')
                 .annotate(is_subscribed=Exists(Follow.objects.filter(
-                    user_id=user_id, author__id=OuterRef('id')))))
+                    user_id=user_id, author__id=OuterRef('author_id')))))
+
+    def get_recipes_limit(self):
+        try:
+            limit = int(self.request.query_params['recipes_limit'])
+        except (KeyError, ValueError):
+            return None
+        return max(limit, 0)
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        follows = list(queryset) if page is None else page
+        # Recipe previews of the whole page come from one query.
+        previews = recipe_previews(
+            [follow.author_id for follow in follows],
+            self.get_recipes_limit())
+        serializer = self.get_serializer(follows, many=True)
+        serializer.context['recipe_previews'] = previews
+        if page is None:
+            return Response(serializer.data)
+        return self.get_paginated_response(serializer.data)
+
+    async def list_async(self, request, *args, **kwargs):
+        window = self.page_window()
+        if window is None:
+            return await database_sync_to_async(self.list)(request)
+        queryset = self.filter_queryset(self.get_queryset())
+        offset, size = window
+        # The previews only need the authors of the page, which a subquery
+        # gives without waiting for the page itself.
+        authors = queryset[offset:offset + size].values('author_id')
+        follows, previews = await asyncio.gather(
+            self.fetch_page(queryset, window),
+            database_sync_to_async(recipe_previews)(
+                authors, self.get_recipes_limit()))
+        serializer = self.get_serializer(follows, many=True)
+        serializer.context['recipe_previews'] = previews
+        return self.get_paginated_response(serializer.data)
 
     def perform_create(self, serializer):
         author = get_object_or_404(User, id=self.kwargs.get('author_id'))
@@ -127,18 +360,38 @@ class FollowViewSet(GenericViewSet, ListModelMixin):
 class FollowChangeViewSet(FollowMixin):
     model = Follow
     serializer_class = FollowSerializer
-    permission_classes = (IsAuthenticated)
+    permission_classes = (IsAuthenticated,)
 
     def get_queryset(self):
         author = get_object_or_404(User, id=self.kwargs.get('author_id'))
         return Follow.objects.filter(author=author)
 
-    def create(self, serializer):
+    @transaction.atomic
+    def perform_create(self, serializer):
         author = get_object_or_404(User, id=self.kwargs.get('author_id'))
+        lock_users([self.request.user.id, author.id])
+        if Follow.objects.filter(user=self.request.user,
+                                 author=author).exists():
+            raise ValidationError('Такая подписка уже есть')
         serializer.save(user=self.request.user, author=author)
+        User.objects.filter(id=author.id).update(
+            followers_count=F('followers_count') + 1)
 
+    @transaction.atomic
     def destroy(self, request, *args, **kwargs):
         author = get_object_or_404(User, id=self.kwargs.get('author_id'))
         user = self.request.user
+        lock_users([user.id, author.id])
         instance = get_object_or_404(Follow, author=author, user=user)
         instance.delete()
+        User.objects.filter(id=author.id).update(
+            followers_count=F('followers_count') - 1)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class MetricsView(APIView):
+    """Requests turned away by the throttles and the concurrency limit."""
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        return Response({'rejected': rejection_counts()})
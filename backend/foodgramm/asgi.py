@@ -0,0 +1,27 @@
+import os
+
+import django
+from asgiref.sync import ThreadSensitiveContext
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'foodgramm.settings')
+os.environ.setdefault('ASYNC_VIEWS', 'True')
+
+# get_asgi_application() with a handler that streams from a thread.
+django.setup(set_prefix=False)
+
+from api.asynchronous import ASGIHandler  # noqa: E402
+
+django_application = ASGIHandler()
+
+# Build the in-memory recipe index before the first request needs it.
+from api.pantry import pantry_index  # noqa: E402
+
+pantry_index.warm()
+
+
+async def application(scope, receive, send):
+    # Django 3.1 runs the synchronous code of every request in one shared
+    # thread. A context per request gives each a thread of its own, as
+    # later Django versions do.
+    async with ThreadSensitiveContext():
+        await django_application(scope, receive, send)
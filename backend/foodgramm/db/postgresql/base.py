@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+from functools import partial
+
+import psycopg2
+from django.db.backends.postgresql import base
+from psycopg2.pool import ThreadedConnectionPool
+
+# A connection idle for less than this is not pinged before use: under
+# ASGI a request opens and closes the connection of a thread several times.
+HEALTH_CHECK_IDLE = 1
+
+
+def is_usable(connection):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+    except psycopg2.Error:
+        return False
+    return True
+
+
+class ConnectionPool(ThreadedConnectionPool):
+    """
+    psycopg2 pool whose connections are opened by Django, so they are set
+    up as unpooled ones are. Waits up to timeout seconds for a free
+    connection instead of failing at once. min_size connections are opened
+    up front and kept when given back, the others are closed.
+    """
+
+    def __init__(self, connect, min_size, max_size, timeout):
+        self.connect = connect
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.returned = {}
+        super().__init__(min_size, max_size)
+
+    def _connect(self, key=None):
+        connection = self.connect()
+        if key is None:
+            self._pool.append(connection)
+        else:
+            self._used[key] = connection
+            self._rused[id(connection)] = key
+        return connection
+
+    def get(self, check):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise psycopg2.OperationalError(
+                f'Нет свободного соединения с базой за {self.timeout} с')
+        try:
+            while True:
+                with self._lock:
+                    connection = self._getconn()
+                    returned = self.returned.pop(id(connection), None)
+                if connection.closed or (
+                        check and returned is not None
+                        and time.monotonic() - returned > HEALTH_CHECK_IDLE
+                        and not is_usable(connection)):
+                    with self._lock:
+                        self._putconn(connection, close=True)
+                    continue
+                return connection
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def put(self, connection):
+        try:
+            with self._lock:
+                self._putconn(connection, close=bool(connection.closed))
+                if connection in self._pool:
+                    self.returned[id(connection)] = time.monotonic()
+        finally:
+            self.slots.release()
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    The PostgreSQL backend with two settings of later Django versions:
+    CONN_HEALTH_CHECKS pings a persistent connection before its first use
+    in a request and reconnects if the server has dropped it, and
+    OPTIONS['pool'] = {'min_size', 'max_size', 'timeout'} takes the
+    connections from a pool of the process, one per database alias.
+    A pool is meant for CONN_MAX_AGE = 0: the connection goes back to the
+    pool at the end of every request.
+    """
+    pools = {}
+    pools_lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.health_check_pending = False
+        self.idle_since = 0
+
+    @property
+    def health_checks(self):
+        return self.settings_dict.get('CONN_HEALTH_CHECKS', False)
+
+    @property
+    def pool(self):
+        options = self.settings_dict['OPTIONS'].get('pool')
+        if not options:
+            return None
+        # A forked worker opens a pool of its own.
+        key = (os.getpid(), self.alias)
+        with self.pools_lock:
+            if key not in self.pools:
+                self.pools[key] = ConnectionPool(
+                    partial(super().get_new_connection,
+                            self.get_connection_params()),
+                    min_size=options.get('min_size', 1),
+                    max_size=options['max_size'],
+                    timeout=options.get('timeout', 30))
+            return self.pools[key]
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        params.pop('pool', None)
+        return params
+
+    def get_new_connection(self, conn_params):
+        pool = self.pool
+        if pool is None:
+            return super().get_new_connection(conn_params)
+        connection = pool.get(self.health_checks)
+        self.isolation_level = self.settings_dict['OPTIONS'].get(
+            'isolation_level', connection.isolation_level)
+        return connection
+
+    def _close(self):
+        pool = self.pool
+        if pool is None or self.connection is None:
+            return super()._close()
+        with self.wrap_database_errors:
+            pool.put(self.connection)
+        # Now it belongs to the pool, even inside an atomic block.
+        self.connection = None
+
+    def connect(self):
+        self.health_check_pending = False
+        super().connect()
+
+    def close_if_unusable_or_obsolete(self):
+        super().close_if_unusable_or_obsolete()
+        if self.connection is not None and not self.health_check_pending:
+            self.health_check_pending = self.health_checks
+            self.idle_since = time.monotonic()
+
+    def ensure_connection(self):
+        if self.health_check_pending and self.connection is not None:
+            self.health_check_pending = False
+            if (time.monotonic() - self.idle_since > HEALTH_CHECK_IDLE
+                    and not self.in_atomic_block and not self.is_usable()):
+                self.close()
+        super().ensure_connection()
@@ -0,0 +1,243 @@
+import asyncio
+import cProfile
+import json
+import logging
+import os
+import random
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from rest_framework.permissions import SAFE_METHODS
+
+from .routers import PIN_KEY, REPLICA, ReplicaReads, replica_reads
+
+logger = logging.getLogger('foodgramm.timing')
+
+current_timings = ContextVar('current_timings', default=None)
+
+IN_LIST = re.compile(r'\((?:%s, )+%s\)')
+
+
+def fingerprint(sql):
+    return IN_LIST.sub('(...)', sql)
+
+
+class RequestTimings:
+
+    def __init__(self):
+        self.queries = 0
+        self.db = 0.0
+        self.serialize = 0.0
+        self.render = 0.0
+        self.fingerprints = Counter()
+        self.depth = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db += time.perf_counter() - started
+            self.queries += 1
+            self.fingerprints[fingerprint(sql)] += 1
+
+    def duplicates(self):
+        return {sql: count for sql, count in self.fingerprints.most_common(5)
+                if count > 1}
+
+
+def timed(attribute, getter):
+    """
+    Wrap a property getter so that the outermost call adds its duration
+    to the timings of the current request.
+    """
+    def wrapper(self):
+        timings = current_timings.get()
+        if timings is None or timings.depth:
+            return getter(self)
+        timings.depth += 1
+        started = time.perf_counter()
+        try:
+            return getter(self)
+        finally:
+            timings.depth -= 1
+            setattr(timings, attribute, getattr(timings, attribute)
+                    + time.perf_counter() - started)
+    return property(wrapper)
+
+
+@contextmanager
+def instrument_connections(timings):
+    """
+    Count the queries of the current thread's connections into timings;
+    worker threads of an async request enter it with current_timings.
+    """
+    with ExitStack() as stack:
+        if timings is not None:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(timings))
+        yield
+
+
+def instrument_rest_framework():
+    from rest_framework.response import Response
+    from rest_framework.serializers import BaseSerializer, ListSerializer
+
+    for serializer in (BaseSerializer, ListSerializer):
+        serializer.data = timed('serialize', serializer.data.fget)
+    Response.rendered_content = timed(
+        'render', Response.rendered_content.fget)
+
+
+class RequestTimingMiddleware:
+    """
+    Reports the query count, database, serializer and renderer time of
+    every request in a Server-Timing header and a JSON log line.
+    Repeated SQL fingerprints are logged to make N+1 queries visible.
+    A sample of requests runs under cProfile and the profile is kept when
+    the request is slower than REQUEST_PROFILE_THRESHOLD_MS.
+    Removes itself from the stack unless REQUEST_TIMING is enabled.
+    Under ASGI the event loop thread is shared by every request, so
+    requests are not profiled there.
+    """
+    instrumented = False
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.REQUEST_TIMING:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.threshold = settings.REQUEST_PROFILE_THRESHOLD_MS
+        self.sample_rate = settings.REQUEST_PROFILE_SAMPLE_RATE
+        if not RequestTimingMiddleware.instrumented:
+            instrument_rest_framework()
+            RequestTimingMiddleware.instrumented = True
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # Tells Django to await the instance, as MiddlewareMixin does.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        profiler = None
+        if self.threshold and random.random() < self.sample_rate:
+            profiler = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            with instrument_connections(timings):
+                if profiler:
+                    profiler.enable()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    if profiler:
+                        profiler.disable()
+        finally:
+            current_timings.reset(token)
+        return self.report(request, response, timings, started, profiler)
+
+    async def __acall__(self, request):
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        started = time.perf_counter()
+        try:
+            with instrument_connections(timings):
+                response = await self.get_response(request)
+        finally:
+            current_timings.reset(token)
+        return self.report(request, response, timings, started)
+
+    def report(self, request, response, timings, started, profiler=None):
+        total = (time.perf_counter() - started) * 1000
+
+        response['Server-Timing'] = ', '.join((
+            f'db;dur={timings.db * 1000:.1f};desc="{timings.queries} queries"',
+            f'serialize;dur={timings.serialize * 1000:.1f}',
+            f'render;dur={timings.render * 1000:.1f}',
+            f'total;dur={total:.1f}',
+        ))
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'total_ms': round(total, 1),
+            'db_ms': round(timings.db * 1000, 1),
+            'queries': timings.queries,
+            'serialize_ms': round(timings.serialize * 1000, 1),
+            'render_ms': round(timings.render * 1000, 1),
+            'duplicates': timings.duplicates(),
+        }, ensure_ascii=False))
+        if profiler and total >= self.threshold:
+            self.dump(profiler, request, total)
+        return response
+
+    def dump(self, profiler, request, total):
+        directory = settings.REQUEST_PROFILE_DIR
+        os.makedirs(directory, exist_ok=True)
+        name = re.sub(r'\W+', '_', request.path).strip('_') or 'root'
+        profiler.dump_stats(os.path.join(
+            directory, f'{time.time():.0f}-{name}-{total:.0f}ms.prof'))
+
+
+class ReplicaMiddleware:
+    """
+    Gives every request the ReplicaReads switch of foodgramm.routers.
+    After a successful write an authenticated user is pinned to the
+    primary for REPLICA_PIN_SECONDS, so that they read what they have
+    just written while the replica catches up. The pins are kept in the
+    default cache, which has to be shared by the workers.
+    Removes itself from the stack unless a replica is configured.
+    """
+    async_capable = True
+
+    def __init__(self, get_response):
+        if REPLICA not in settings.DATABASES:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = replica_reads.set(ReplicaReads())
+        try:
+            response = self.get_response(request)
+        finally:
+            replica_reads.reset(token)
+        if self.wrote(request, response):
+            self.pin(request)
+        return response
+
+    async def __acall__(self, request):
+        token = replica_reads.set(ReplicaReads())
+        try:
+            response = await self.get_response(request)
+        finally:
+            replica_reads.reset(token)
+        if self.wrote(request, response):
+            # The user may be a lazy object that still has to be loaded.
+            await sync_to_async(self.pin)(request)
+        return response
+
+    def wrote(self, request, response):
+        return (request.method not in SAFE_METHODS
+                and response.status_code < 400)
+
+    def pin(self, request):
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            cache.set(PIN_KEY.format(user.id), True,
+                      settings.REPLICA_PIN_SECONDS)
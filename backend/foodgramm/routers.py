@@ -0,0 +1,45 @@
+from contextvars import ContextVar
+
+from django.conf import settings
+
+REPLICA = 'replica'
+PIN_KEY = 'replica-pin:{}'
+
+# Set for every request by ReplicaMiddleware; the worker threads of an
+# async request see the same object.
+replica_reads = ContextVar('replica_reads', default=None)
+
+
+class ReplicaReads:
+    enabled = False
+
+
+class ReplicaRouter:
+    """
+    Sends the reads of a request to the 'replica' database once a view
+    has enabled it, see api.mixins.ReplicaReadMixin. Everything else,
+    writes and migrations included, goes to 'default'; the replica is
+    kept up to date by the database itself.
+    """
+
+    def db_for_read(self, model, **hints):
+        reads = replica_reads.get()
+        if (reads is not None and reads.enabled
+                and REPLICA in settings.DATABASES):
+            return REPLICA
+        return None
+
+    def db_for_write(self, model, **hints):
+        # Otherwise an object read from the replica would be saved there.
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = {'default', REPLICA}
+        if {obj1._state.db, obj2._state.db} <= aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == REPLICA:
+            return False
+        return None
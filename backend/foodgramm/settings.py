@@ -27,7 +27,7 @@ INSTALLED_APPS = [
     'rest_framework',
     'rest_framework.authtoken',
     'djoser',
-    'api',
+    'api.apps.ApiConfig',
     'recipes',
     'foodgramm',
     'users',
@@ -36,16 +36,25 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'foodgramm.middleware.RequestTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'foodgramm.middleware.ReplicaMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
 ]
 
+# Set by foodgramm.asgi: read endpoints are served by coroutines.
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', default='False') == 'True'
+if ASYNC_VIEWS:
+    # The toolbar is synchronous only and would pin every request to a
+    # thread of its own.
+    MIDDLEWARE.remove('debug_toolbar.middleware.DebugToolbarMiddleware')
+
 ROOT_URLCONF = 'foodgramm.urls'
 
 TEMPLATES = [
@@ -67,14 +76,57 @@ TEMPLATES = [
 WSGI_APPLICATION = 'foodgramm.wsgi.application'
 
 
+DB_ENGINE = os.getenv('DB_ENGINE', default='foodgramm.db.postgresql')
+if DB_ENGINE in ('django.db.backends.postgresql',
+                 'django.db.backends.postgresql_psycopg2'):
+    # The same backend with health checks and a connection pool.
+    DB_ENGINE = 'foodgramm.db.postgresql'
+# 0 keeps the connections per request; with a pool they go back to it.
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', default=0))
+DB_OPTIONS = {}
+if DB_POOL_MAX_SIZE and DB_ENGINE == 'foodgramm.db.postgresql':
+    DB_OPTIONS['pool'] = {
+        'min_size': int(os.getenv('DB_POOL_MIN_SIZE', default=2)),
+        'max_size': DB_POOL_MAX_SIZE,
+        'timeout': float(os.getenv('DB_POOL_TIMEOUT', default=30)),
+    }
+
 DATABASES = {
     'default': {
-        'ENGINE': os.getenv('DB_ENGINE', default='django.db.backends.postgresql'),
+        'ENGINE': DB_ENGINE,
         'NAME': os.getenv('DB_NAME', default='postgres'),
         'USER': os.getenv('POSTGRES_USER', default='postgres'),
         'PASSWORD': os.getenv('POSTGRES_PASSWORD', default='postgres'),
         'HOST': os.getenv('DB_HOST', default='127.0.0.1'),
-        'PORT': os.getenv('DB_PORT', default=5432)}
+        'PORT': os.getenv('DB_PORT', default=5432),
+        'CONN_MAX_AGE': 0 if DB_OPTIONS else int(
+            os.getenv('DB_CONN_MAX_AGE', default=60)),
+        'CONN_HEALTH_CHECKS': os.getenv(
+            'DB_CONN_HEALTH_CHECKS', default='True') == 'True',
+        'OPTIONS': DB_OPTIONS}
+}
+
+# A read replica for the safe methods of the recipe and user views, see
+# foodgramm.routers. Locally a copy of a SQLite file will do.
+if os.getenv('DB_REPLICA_HOST') or os.getenv('DB_REPLICA_NAME'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': os.getenv('DB_REPLICA_NAME', default=DATABASES['default']['NAME']),
+        'HOST': os.getenv('DB_REPLICA_HOST', default=DATABASES['default']['HOST']),
+        'PORT': os.getenv('DB_REPLICA_PORT', default=DATABASES['default']['PORT']),
+        'OPTIONS': dict(DB_OPTIONS),
+        'TEST': {'MIRROR': 'default'}}
+DATABASE_ROUTERS = ['foodgramm.routers.ReplicaRouter']
+# How long a user who has written reads from the primary.
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', default=5))
+
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', default='foodgram'),
+        'TIMEOUT': int(os.getenv('CACHE_TIMEOUT', default=300)),
+    }
 }
 
 
@@ -111,6 +163,13 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Larger uploads, multipart or base64, are spooled to temporary files.
+FILE_UPLOAD_MAX_MEMORY_SIZE = int(
+    os.getenv('FILE_UPLOAD_MAX_MEMORY_SIZE', default=2621440))
+FILE_UPLOAD_TEMP_DIR = os.getenv('FILE_UPLOAD_TEMP_DIR')
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', default=2))
+IMAGE_MAX_DIMENSION = int(os.getenv('IMAGE_MAX_DIMENSION', default=6000))
+
 AUTH_USER_MODEL = 'users.User'
 
 REST_FRAMEWORK = {
@@ -119,13 +178,62 @@ REST_FRAMEWORK = {
     ],
 
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend'
-    ]
+    ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    # Token buckets of api.throttling, "<requests>/<s|m|h|d>": that many
+    # at once, refilled over the period. Empty turns a scope off.
+    'DEFAULT_THROTTLE_RATES': {
+        'export': os.getenv('THROTTLE_EXPORT_RATE', default='10/m'),
+        'upload': os.getenv('THROTTLE_UPLOAD_RATE', default='20/m'),
+        'register': os.getenv('THROTTLE_REGISTER_RATE', default='5/m'),
+    },
+    # nginx in front adds the address it saw to X-Forwarded-For.
+    'NUM_PROXIES': int(os.getenv('NUM_PROXIES', default=1)),
+}
+
+# Exports, recipe uploads and registrations running at once in a worker;
+# more are answered with 503 and Retry-After. 0 for no limit.
+HEAVY_REQUESTS_PER_WORKER = int(os.getenv('HEAVY_REQUESTS_PER_WORKER', default=4))
+HEAVY_RETRY_AFTER = int(os.getenv('HEAVY_RETRY_AFTER', default=2))
+
+# Token lookups cached by api.authentication; a changed user may stay
+# authenticated as before in other workers for up to TOKEN_CACHE_TTL.
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', default=10000))
+TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', default=30))
+# Alias of a cache shared by the workers, e.g. memcached; empty for none.
+TOKEN_CACHE_BACKEND = os.getenv('TOKEN_CACHE_BACKEND', default='')
+
+REQUEST_TIMING = os.getenv('REQUEST_TIMING', default='False') == 'True'
+REQUEST_PROFILE_THRESHOLD_MS = float(os.getenv('REQUEST_PROFILE_THRESHOLD_MS', default=0))
+REQUEST_PROFILE_SAMPLE_RATE = float(os.getenv('REQUEST_PROFILE_SAMPLE_RATE', default=0.1))
+REQUEST_PROFILE_DIR = os.getenv('REQUEST_PROFILE_DIR', default=os.path.join(BASE_DIR, 'profiles'))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'foodgramm.timing': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
 }
 
+INGREDIENT_SEARCH_LIMIT = int(os.getenv('INGREDIENT_SEARCH_LIMIT', default=50))
+
 
 DJOSER = {
     'LOGIN_FIELD': 'email',
@@ -5,3 +5,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'foodgramm.settings')
 
 application = get_wsgi_application()
+
+# Build the in-memory recipe index before the first request needs it.
+from api.pantry import pantry_index  # noqa: E402
+
+pantry_index.warm()
@@ -1,11 +1,71 @@
+from api.cards import refresh_cards
 from django.contrib import admin
 from recipes.models import (Favorite, Follow, Ingredient, Recipe,
                             RecipeIngredient, ShoppingCart, Tag)
+from recipes.search import index_recipes
+from recipes.shopping import rebuild_lists
+
+
+def buyers(recipe_ids):
+    return list(ShoppingCart.objects.filter(recipes_id__in=recipe_ids)
+                .values_list('user_id', flat=True).distinct())
+
+
+def recipes_changed(recipe_ids):
+    """
+    Bring what is derived from the ingredients of the recipes up to date.
+    Admin edits are rare, so the shopping lists are recomputed whole.
+    """
+    index_recipes(recipe_ids)
+    refresh_cards(recipe_ids)
+    rebuild_lists(buyers(recipe_ids))
+
+
+class RecipeAdmin(admin.ModelAdmin):
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        index_recipes([form.instance.id])
+        refresh_cards([form.instance.id])
+
+
+class RecipeIngredientAdmin(admin.ModelAdmin):
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # The row may have been moved to another recipe.
+        recipes_changed({obj.recipe_id, form.initial.get('recipe')} - {None})
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        recipes_changed([obj.recipe_id])
+
+    def delete_queryset(self, request, queryset):
+        recipe_ids = list(queryset.values_list('recipe_id', flat=True))
+        super().delete_queryset(request, queryset)
+        recipes_changed(recipe_ids)
+
+
+class ShoppingCartAdmin(admin.ModelAdmin):
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        rebuild_lists({obj.user_id, form.initial.get('user')} - {None})
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        rebuild_lists([obj.user_id])
+
+    def delete_queryset(self, request, queryset):
+        user_ids = list(queryset.values_list('user_id', flat=True))
+        super().delete_queryset(request, queryset)
+        rebuild_lists(user_ids)
+
 
 admin.site.register(Tag)
 admin.site.register(Ingredient)
-admin.site.register(Recipe)
-admin.site.register(ShoppingCart)
+admin.site.register(Recipe, RecipeAdmin)
+admin.site.register(ShoppingCart, ShoppingCartAdmin)
 admin.site.register(Favorite)
 admin.site.register(Follow)
-admin.site.register(RecipeIngredient)
+admin.site.register(RecipeIngredient, RecipeIngredientAdmin)
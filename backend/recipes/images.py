@@ -0,0 +1,139 @@
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from api.cache import bump
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from PIL import Image, ImageOps
+
+from .models import Recipe
+
+logger = logging.getLogger(__name__)
+
+# Longest side of every variant, in pixels.
+VARIANTS = {
+    'card': 480,
+    'detail': 1200,
+}
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True,
+                      'progressive': True}),
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = set()
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.IMAGE_WORKERS,
+                    thread_name_prefix='recipe-images')
+    return _executor
+
+
+def flatten(image):
+    """JPEG has no alpha channel: put transparent images on white."""
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def render_variants(name):
+    """Write every size/format variant of a stored image, return paths."""
+    with default_storage.open(name) as f:
+        original = ImageOps.exif_transpose(Image.open(f))
+        original.load()
+    stem = os.path.splitext(name)[0]
+    variants = {}
+    for label, side in VARIANTS.items():
+        image = original.copy()
+        image.thumbnail((side, side), Image.LANCZOS)
+        variants[label] = {}
+        for extension, (image_format, options) in FORMATS.items():
+            buffer = io.BytesIO()
+            target = image if image_format == 'WEBP' else flatten(image)
+            target.save(buffer, image_format, **options)
+            variants[label][extension] = default_storage.save(
+                f'{stem}-{label}.{extension}', ContentFile(buffer.getvalue()))
+    return variants
+
+
+def stored_files(recipe):
+    """Paths of the recipe image and of every variant made from it."""
+    if not recipe.image:
+        return []
+    return [recipe.image.name] + [
+        path for formats in recipe.image_variants.values()
+        for path in formats.values()]
+
+
+def delete_files(names):
+    for name in names:
+        default_storage.delete(name)
+
+
+def store_variants(recipe_id, name, replaced=()):
+    """
+    Render and attach the variants of the image, then delete the files
+    of the image it replaced once that is committed.
+    """
+    stale = list(replaced)
+    try:
+        variants = render_variants(name)
+    except (OSError, ValueError):
+        logger.exception('Не удалось подготовить варианты %s', name)
+    else:
+        # The image may have been replaced while this one was rendered.
+        if Recipe.objects.filter(id=recipe_id, image=name).update(
+                image_variants=variants):
+            # update() sends no signal; cached details still show no
+            # variants.
+            bump('recipes')
+        else:
+            stale += [path for formats in variants.values()
+                      for path in formats.values()]
+    transaction.on_commit(lambda: delete_files(stale))
+
+
+def build_variants(recipe_id, name, replaced):
+    try:
+        store_variants(recipe_id, name, replaced)
+    finally:
+        connections.close_all()
+
+
+def schedule_variants(recipe, replaced=()):
+    """
+    Render the variants of the recipe image in the background worker
+    pool, or inline when IMAGE_WORKERS is 0. The files in replaced,
+    left from the previous image, are deleted after that.
+    """
+    if not recipe.image:
+        delete_files(replaced)
+        return
+    if not settings.IMAGE_WORKERS:
+        store_variants(recipe.id, recipe.image.name, replaced)
+        return
+    future = executor().submit(
+        build_variants, recipe.id, recipe.image.name, replaced)
+    _pending.add(future)
+    future.add_done_callback(_pending.discard)
+
+
+def drain(timeout=None):
+    """Wait until every scheduled variant has been written."""
+    wait(list(_pending), timeout=timeout)
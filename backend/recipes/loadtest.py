@@ -0,0 +1,99 @@
+import random
+import uuid
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+
+from .models import (Favorite, Follow, Ingredient, Recipe, RecipeIngredient,
+                     ShoppingCart, Tag)
+from .search import index_recipes
+from .shopping import rebuild_lists
+from users.models import User
+
+TAGS = (
+    ('Завтрак', '#E26C2D', 'breakfast'),
+    ('Обед', '#49B64E', 'lunch'),
+    ('Ужин', '#8775D2', 'dinner'),
+)
+PASSWORD = 'loadtest-password'
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+def seed_tags():
+    Tag.objects.bulk_create(
+        [Tag(name=name, color=color, slug=slug)
+         for name, color, slug in TAGS],
+        ignore_conflicts=True)
+    return list(Tag.objects.values_list('id', flat=True))
+
+
+def seed_users(count, batch_size=1000):
+    """Create synthetic users sharing one password and return their ids."""
+    prefix = f'loadtest-{uuid.uuid4().hex[:8]}-'
+    password = make_password(PASSWORD)
+    users = (User(username=f'{prefix}{number}',
+                  email=f'{prefix}{number}@foodgram.local',
+                  first_name='Нагрузочный', last_name=f'Тест {number}',
+                  password=password)
+             for number in range(count))
+    for batch in batched(users, batch_size):
+        User.objects.bulk_create(batch)
+    return list(User.objects.filter(username__startswith=prefix)
+                .values_list('id', flat=True))
+
+
+def seed_recipes(author_ids, count, ingredients_per_recipe=8,
+                 batch_size=1000, rnd=random):
+    """Create synthetic recipes with random tags and ingredients."""
+    marker = f'Рецепт {uuid.uuid4().hex[:8]}'
+    ingredient_ids = list(Ingredient.objects.values_list('id', flat=True))
+    tag_ids = seed_tags()
+    per_recipe = min(ingredients_per_recipe, len(ingredient_ids))
+    recipes = (Recipe(author_id=rnd.choice(author_ids),
+                      name=f'{marker} №{number}',
+                      text='Синтетический рецепт для нагрузочного теста.',
+                      cooking_time=rnd.randint(1, 180))
+               for number in range(count))
+    for batch in batched(recipes, batch_size):
+        Recipe.objects.bulk_create(batch)
+    recipe_ids = list(Recipe.objects.filter(name__startswith=marker)
+                      .values_list('id', flat=True))
+    recipe_tag = Recipe.tags.through
+    links = (recipe_tag(recipe_id=recipe_id, tag_id=tag_id)
+             for recipe_id in recipe_ids
+             for tag_id in rnd.sample(tag_ids, rnd.randint(1, len(tag_ids))))
+    for batch in batched(links, batch_size):
+        recipe_tag.objects.bulk_create(batch)
+    amounts = (RecipeIngredient(recipe_id=recipe_id, ingredient_id=pk,
+                                amount=rnd.randint(1, 500))
+               for recipe_id in recipe_ids
+               for pk in rnd.sample(ingredient_ids, per_recipe))
+    for batch in batched(amounts, batch_size):
+        RecipeIngredient.objects.bulk_create(batch)
+    index_recipes(recipe_ids)
+    return recipe_ids
+
+
+def seed_relations(user_ids, recipe_ids, favorites=0, carts=0, follows=0,
+                   batch_size=1000, rnd=random):
+    """Give every user random favourites, cart recipes and subscriptions."""
+    for model, per_user, field, targets in (
+            (Favorite, favorites, 'recipes_id', recipe_ids),
+            (ShoppingCart, carts, 'recipes_id', recipe_ids),
+            (Follow, follows, 'author_id', user_ids)):
+        per_user = min(per_user, len(targets))
+        rows = (model(user_id=user_id, **{field: target})
+                for user_id in user_ids
+                for target in rnd.sample(targets, per_user)
+                if target != user_id or model is not Follow)
+        for batch in batched(rows, batch_size):
+            model.objects.bulk_create(batch, ignore_conflicts=True)
+    if carts:
+        rebuild_lists(user_ids)
@@ -0,0 +1,98 @@
+import random
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Sum
+from recipes.loadtest import seed_recipes, seed_relations, seed_users
+from recipes.models import (Favorite, Follow, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingCart, Tag)
+
+FULL_SCAN = {
+    'postgresql': re.compile(r'Seq Scan on (\w+)'),
+    'sqlite': re.compile(r'\bSCAN (?:TABLE )?(\w+)'),
+}
+
+
+def hot_queries(user_id, author_id, recipe_id, tag_slug):
+    """Queries behind the recipe filters, per-user flags and feeds."""
+    # Filters are explained without the page ordering and LIMIT: walking
+    # the primary key backwards is a valid plan for a short page and would
+    # hide whether the filter itself is backed by an index.
+    queries = {
+        'recipes_by_author': Recipe.objects.filter(author_id=author_id),
+        'recipes_by_tag': Recipe.objects.filter(
+            tags__slug=tag_slug).order_by(),
+        'favorited_recipes': Recipe.objects.filter(
+            favorite__user_id=user_id).order_by(),
+        'recipes_in_cart': Recipe.objects.filter(
+            shoppingcart__user_id=user_id).order_by(),
+        'is_favorited': Favorite.objects.filter(
+            user_id=user_id, recipes_id=recipe_id),
+        'is_in_shopping_cart': ShoppingCart.objects.filter(
+            user_id=user_id, recipes_id=recipe_id),
+        'recipe_favorited_by': Favorite.objects.filter(recipes_id=recipe_id),
+        'recipe_in_carts': ShoppingCart.objects.filter(recipes_id=recipe_id),
+        'subscriptions': Follow.objects.filter(user_id=user_id),
+        'is_subscribed': Follow.objects.filter(
+            user_id=user_id, author_id=author_id),
+        'shopping_list': RecipeIngredient.objects.filter(
+            recipe__shoppingcart__user_id=user_id).values(
+            'ingredient__name', 'ingredient__measurement_unit').annotate(
+            total=Sum('amount')),
+    }
+    if connection.vendor == 'postgresql':
+        # SQLite cannot serve a case-insensitive LIKE from an index.
+        queries['ingredient_prefix'] = Ingredient.objects.filter(
+            name__istartswith='аб')
+    return queries
+
+
+class Command(BaseCommand):
+    help = ('Проверяет по EXPLAIN, что частые запросы не читают '
+            'таблицы целиком')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--recipes', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        pattern = FULL_SCAN.get(connection.vendor)
+        if pattern is None:
+            raise CommandError(
+                f'EXPLAIN для {connection.vendor} не поддерживается')
+        if not Ingredient.objects.exists():
+            raise CommandError('Сначала загрузите ингредиенты: load_data')
+        failed = self.explain_hot_queries(pattern, options)
+        if failed:
+            raise CommandError(f'Полное чтение таблиц: {", ".join(failed)}')
+
+    @transaction.atomic
+    def explain_hot_queries(self, pattern, options):
+        rnd = random.Random(options['seed'])
+        user_ids = seed_users(options['users'])
+        recipe_ids = seed_recipes(user_ids, options['recipes'], rnd=rnd)
+        seed_relations(user_ids, recipe_ids, 20, 10, 10, rnd=rnd)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+            if connection.vendor == 'postgresql':
+                # With sequential scans priced out, any that remain have
+                # no usable index behind them.
+                cursor.execute('SET LOCAL enable_seqscan = off')
+
+        failed = []
+        queries = hot_queries(rnd.choice(user_ids), rnd.choice(user_ids),
+                              rnd.choice(recipe_ids),
+                              Tag.objects.values_list('slug', flat=True)[0])
+        for name, queryset in queries.items():
+            plan = queryset.explain()
+            scans = pattern.findall(plan)
+            if scans:
+                failed.append(name)
+                self.stdout.write(f'{name}: SCAN {", ".join(scans)}')
+                self.stdout.write(plan)
+            else:
+                self.stdout.write(f'{name}: ok')
+        transaction.set_rollback(True)
+        return failed
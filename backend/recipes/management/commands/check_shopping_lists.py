@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+from recipes.models import ShoppingListItem
+from recipes.shopping import aggregate_lists, rebuild_lists
+
+CHUNK_SIZE = 10000
+
+
+def keyed(rows):
+    for user_id, ingredient_id, *values in rows:
+        yield (user_id, ingredient_id), tuple(values)
+
+
+def mismatches(stored, actual):
+    """
+    Walk two row streams ordered by (user_id, ingredient_id) side by side
+    and yield the keys whose values differ or exist on one side only.
+    """
+    stored, actual = keyed(stored), keyed(actual)
+    left, right = next(stored, None), next(actual, None)
+    while left or right:
+        if right is None or left and left[0] < right[0]:
+            yield left[0]
+            left = next(stored, None)
+        elif left is None or right[0] < left[0]:
+            yield right[0]
+            right = next(actual, None)
+        else:
+            if left[1] != right[1]:
+                yield left[0]
+            left, right = next(stored, None), next(actual, None)
+
+
+class Command(BaseCommand):
+    help = ('Сверяет списки покупок с корзинами пользователей и, с --fix, '
+            'пересчитывает расходящиеся')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true',
+                            help='Пересчитать списки с расхождениями')
+
+    def handle(self, *args, **options):
+        stored = (ShoppingListItem.objects
+                  .order_by('user_id', 'ingredient_id')
+                  .values_list('user_id', 'ingredient_id', 'total',
+                               'recipes_count')
+                  .iterator(chunk_size=CHUNK_SIZE))
+        actual = aggregate_lists().iterator(chunk_size=CHUNK_SIZE)
+        rows, user_ids = 0, set()
+        for user_id, _ in mismatches(stored, actual):
+            rows += 1
+            user_ids.add(user_id)
+        self.stdout.write(f'Расхождений: {rows} строк у '
+                          f'{len(user_ids)} пользователей')
+        if not user_ids:
+            return
+        if not options['fix']:
+            raise CommandError('Списки покупок расходятся с корзинами')
+        rebuild_lists(sorted(user_ids))
+        self.stdout.write(f'Пересчитано списков: {len(user_ids)}')
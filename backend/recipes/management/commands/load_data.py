@@ -1,16 +1,136 @@
+import csv
+import io
 import json
+import os
+import time
 
-from django.core.management.base import BaseCommand
+from api.cache import bump
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from recipes.loadtest import batched, seed_recipes, seed_tags, seed_users
 from recipes.models import Ingredient
+from users.models import User
+
+COPY_TABLE = 'load_data_ingredient'
+
+
+def read_json(path):
+    with open(path, encoding='utf-8') as f:
+        for item in json.load(f):
+            yield item['name'], item['measurement_unit']
+
+
+def read_csv(path):
+    with open(path, encoding='utf-8', newline='') as f:
+        for name, measurement_unit in csv.reader(f):
+            yield name, measurement_unit
+
+
+READERS = {'.json': read_json, '.csv': read_csv}
 
 
 class Command(BaseCommand):
+    help = ('Загружает ингредиенты из JSON или CSV и при необходимости '
+            'создаёт тэги и синтетические данные для нагрузочных тестов')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path',
+            default=os.path.join(settings.BASE_DIR, 'ingredients.json'),
+            help='Файл с ингредиентами (.json или .csv)')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Только прочитать файл, ничего не записывая')
+        parser.add_argument(
+            '--tags', action='store_true', help='Создать базовые тэги')
+        parser.add_argument(
+            '--users', type=int, default=0,
+            help='Сколько синтетических пользователей создать')
+        parser.add_argument(
+            '--recipes', type=int, default=0,
+            help='Сколько синтетических рецептов создать')
+
     def handle(self, *args, **options):
-        with open('ingredients.json', 'rb') as f:
-            data = json.load(f)
-            for i in data:
-                ingredient = Ingredient()
-                ingredient.name = i['name']
-                ingredient.measurement_unit = i['measurement_unit']
-                ingredient.save()
-                print(i['name'], i['measurement_unit'])
+        path = options['path']
+        reader = READERS.get(os.path.splitext(path)[1].lower())
+        if reader is None:
+            raise CommandError('Поддерживаются только файлы .json и .csv')
+        if not os.path.exists(path):
+            raise CommandError(f'Файл {path} не найден')
+        insert = (self.copy_batch if connection.vendor == 'postgresql'
+                  else self.insert_batch)
+        dry_run = options['dry_run']
+
+        started = time.perf_counter()
+        read = created = 0
+        with transaction.atomic():
+            for batch in batched(reader(path), options['batch_size']):
+                read += len(batch)
+                if not dry_run:
+                    created += insert(batch)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f'Прочитано {read}, добавлено {created} ингредиентов '
+            f'за {elapsed:.2f} с ({read / max(elapsed, 1e-9):.0f} строк/с)')
+
+        if dry_run:
+            return
+        if created:
+            # Bulk inserts send no signals: retire the cached ingredient
+            # list and the autocomplete indexes of the workers.
+            bump('ingredients')
+        if options['tags']:
+            seed_tags()
+            bump('tags')
+        if options['users'] or options['recipes']:
+            self.seed(options['users'], options['recipes'],
+                      options['batch_size'])
+
+    def insert_batch(self, batch):
+        before = Ingredient.objects.count()
+        Ingredient.objects.bulk_create(
+            [Ingredient(name=name, measurement_unit=measurement_unit)
+             for name, measurement_unit in batch],
+            ignore_conflicts=True)
+        return Ingredient.objects.count() - before
+
+    def copy_batch(self, batch):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(batch)
+        buffer.seek(0)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE TEMP TABLE IF NOT EXISTS {COPY_TABLE} '
+                f'(name varchar(200), measurement_unit varchar(200)) '
+                f'ON COMMIT DROP')
+            cursor.copy_expert(
+                f'COPY {COPY_TABLE} FROM STDIN WITH (FORMAT csv)', buffer)
+            cursor.execute(
+                f'INSERT INTO {Ingredient._meta.db_table} '
+                f'(name, measurement_unit) '
+                f'SELECT name, measurement_unit FROM {COPY_TABLE} '
+                f'ON CONFLICT (name) DO NOTHING')
+            created = cursor.rowcount
+            cursor.execute(f'TRUNCATE {COPY_TABLE}')
+        return created
+
+    def seed(self, users, recipes, batch_size):
+        started = time.perf_counter()
+        with transaction.atomic():
+            if users:
+                author_ids = seed_users(users, batch_size)
+            else:
+                author_ids = list(User.objects.values_list('id', flat=True))
+            if not author_ids:
+                raise CommandError('Нет пользователей для авторов рецептов')
+            recipe_ids = seed_recipes(author_ids, recipes,
+                                      batch_size=batch_size)
+        call_command('recount', stdout=io.StringIO())
+        # Bulk inserts send no signals: retire cached recipes and indexes.
+        bump('recipes', 'pantry')
+        self.stdout.write(
+            f'Создано {users} пользователей и {len(recipe_ids)} '
+            f'рецептов за {time.perf_counter() - started:.2f} с')
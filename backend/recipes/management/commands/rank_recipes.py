@@ -0,0 +1,179 @@
+import time
+
+import numpy as np
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from recipes.loadtest import batched
+from recipes.models import (Favorite, Recipe, RecipeIngredient, ShoppingCart,
+                            SimilarRecipe)
+from scipy import sparse
+
+LOCK_KEY = 'rank_recipes:lock'
+LOCK_TIMEOUT = 60 * 60
+# A recipe put in a shopping cart is about to be cooked.
+INTERACTIONS = (
+    (Favorite, 1.0),
+    (ShoppingCart, 2.0),
+)
+
+
+def row_normalized(matrix):
+    """Scale every row to unit length, so dot products are cosines."""
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1))).ravel()
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms) @ matrix
+
+
+def incidence(recipe_ids, pairs):
+    """Recipes by features matrix from (recipe id, feature id) pairs."""
+    pairs = np.array(list(pairs), dtype=np.int64).reshape(-1, 2)
+    rows = np.searchsorted(recipe_ids, pairs[:, 0])
+    features, cols = np.unique(pairs[:, 1], return_inverse=True)
+    return sparse.csr_matrix(
+        (np.ones(len(pairs)), (rows, cols)),
+        shape=(len(recipe_ids), len(features)))
+
+
+def chunks(ingredients, budget):
+    """
+    Split the rows so that each chunk of the similarity product has at
+    most about budget candidate pairs, whatever the ingredient spread.
+    """
+    frequency = np.asarray((ingredients > 0).sum(axis=0)).ravel()
+    candidates = np.cumsum((ingredients > 0) @ frequency)
+    start = 0
+    while start < len(candidates):
+        offset = candidates[start - 1] if start else 0
+        end = max(int(np.searchsorted(candidates, offset + budget,
+                                      side='right')), start + 1)
+        yield start, end
+        start = end
+
+
+def popularity(recipe_ids, half_life):
+    """Favourites and cart additions, each halving every half_life days."""
+    now = timezone.now().timestamp()
+    scores = np.zeros(len(recipe_ids))
+    for model, weight in INTERACTIONS:
+        rows = list(model.objects.values_list('recipes_id', 'created'))
+        if not rows:
+            continue
+        positions = np.searchsorted(
+            recipe_ids, np.fromiter((row[0] for row in rows), np.int64))
+        ages = (now - np.fromiter((row[1].timestamp() for row in rows),
+                                  np.float64)) / 86400
+        scores += weight * np.bincount(
+            positions, weights=np.exp2(-np.maximum(ages, 0) / half_life),
+            minlength=len(recipe_ids))
+    return scores
+
+
+def similar(recipe_ids, top, tag_weight, budget):
+    """
+    Top similar recipes for every recipe: the cosine of the ingredient
+    vectors, weighted by inverse frequency so that salt counts for little,
+    blended with the cosine of the tag vectors. Only recipes that share at
+    least one ingredient are compared, which keeps the product sparse.
+    Yields (recipe id, similar id, score).
+    """
+    ingredients = incidence(recipe_ids, RecipeIngredient.objects.values_list(
+        'recipe_id', 'ingredient_id'))
+    frequency = np.asarray(ingredients.sum(axis=0)).ravel()
+    ingredients = row_normalized(
+        ingredients @ sparse.diags(np.log1p(len(recipe_ids) / frequency)))
+    # There are few tags, a dense matrix is the cheapest to index.
+    tags = row_normalized(incidence(
+        recipe_ids, Recipe.tags.through.objects.values_list(
+            'recipe_id', 'tag_id'))).toarray()
+    transposed = ingredients.T.tocsr()
+    for start, end in chunks(ingredients, budget):
+        product = (ingredients[start:end] @ transposed).tocoo()
+        rows, cols = product.row, product.col
+        scores = ((1 - tag_weight) * product.data + tag_weight
+                  * np.einsum('ij,ij->i', tags[rows + start], tags[cols]))
+        scores[rows + start == cols] = 0
+        scores = sparse.csr_matrix((scores, (rows, cols)),
+                                   shape=product.shape)
+        scores.eliminate_zeros()
+        for row in range(scores.shape[0]):
+            begin, end = scores.indptr[row], scores.indptr[row + 1]
+            data, columns = scores.data[begin:end], scores.indices[begin:end]
+            if len(data) > top:
+                best = np.argpartition(-data, top)[:top]
+                data, columns = data[best], columns[best]
+            recipe_id = int(recipe_ids[start + row])
+            for column, score in zip(columns, data):
+                yield recipe_id, int(recipe_ids[column]), float(score)
+
+
+class Command(BaseCommand):
+    help = ('Пересчитывает популярность рецептов и списки похожих '
+            'рецептов; можно запускать по расписанию')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--half-life', type=float, default=14,
+                            help='Дней, за которые вклад действия '
+                                 'уменьшается вдвое')
+        parser.add_argument('--top', type=int, default=10,
+                            help='Похожих рецептов на каждый рецепт')
+        parser.add_argument('--tag-weight', type=float, default=0.2,
+                            help='Вес совпадения тегов, от 0 до 1')
+        parser.add_argument('--budget', type=int, default=2000000,
+                            help='Пар-кандидатов в одной порции расчёта')
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        if not cache.add(LOCK_KEY, True, LOCK_TIMEOUT):
+            raise CommandError('Пересчёт уже идёт')
+        try:
+            self.rank(options)
+        finally:
+            cache.delete(LOCK_KEY)
+
+    def rank(self, options):
+        started = time.perf_counter()
+        recipe_ids = np.fromiter(
+            Recipe.objects.order_by('id').values_list('id', flat=True),
+            np.int64)
+        scores = popularity(recipe_ids, options['half_life'])
+        updated = self.save_popularity(recipe_ids, scores,
+                                       options['batch_size'])
+        self.stdout.write(f'Популярность: обновлено {updated} рецептов за '
+                          f'{time.perf_counter() - started:.1f} с')
+
+        started = time.perf_counter()
+        pairs = similar(recipe_ids, options['top'], options['tag_weight'],
+                        options['budget'])
+        saved = self.save_similar(pairs, options['batch_size'])
+        self.stdout.write(f'Похожие рецепты: {saved} пар за '
+                          f'{time.perf_counter() - started:.1f} с')
+
+    @transaction.atomic
+    def save_popularity(self, recipe_ids, scores, batch_size):
+        current = dict(Recipe.objects.values_list('id', 'popularity'))
+        changed = (Recipe(id=int(recipe_id), popularity=float(score))
+                   for recipe_id, score in zip(recipe_ids, scores)
+                   if int(recipe_id) in current
+                   and not np.isclose(current[int(recipe_id)], score))
+        updated = 0
+        for batch in batched(changed, batch_size):
+            Recipe.objects.bulk_update(batch, ['popularity'])
+            updated += len(batch)
+        return updated
+
+    @transaction.atomic
+    def save_similar(self, pairs, batch_size):
+        # Readers keep the previous lists until the new ones are committed.
+        SimilarRecipe.objects.all().delete()
+        existing = set(Recipe.objects.values_list('id', flat=True))
+        rows = (SimilarRecipe(recipe_id=recipe_id, similar_id=similar_id,
+                              score=score)
+                for recipe_id, similar_id, score in pairs
+                if recipe_id in existing and similar_id in existing)
+        saved = 0
+        for batch in batched(rows, batch_size):
+            SimilarRecipe.objects.bulk_create(batch)
+            saved += len(batch)
+        return saved
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from recipes.models import Favorite, Follow, Recipe
+from users.models import User
+
+COUNTERS = (
+    (Recipe, 'favorites_count', Favorite, 'recipes'),
+    (User, 'recipes_count', Recipe, 'author'),
+    (User, 'followers_count', Follow, 'author'),
+)
+
+
+def actual_count(model, related_field):
+    return Coalesce(Subquery(
+        model.objects.filter(**{related_field: OuterRef('pk')})
+        .order_by().values(related_field)
+        .annotate(total=Count('pk')).values('total')), 0)
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает денормализованные счётчики'
+
+    def handle(self, *args, **options):
+        for model, field, counted, related_field in COUNTERS:
+            actual = actual_count(counted, related_field)
+            with transaction.atomic():
+                fixed = (model.objects.exclude(**{field: actual})
+                         .update(**{field: actual}))
+            self.stdout.write(
+                f'{model._meta.model_name}.{field}: исправлено {fixed}')
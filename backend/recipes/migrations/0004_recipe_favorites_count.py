@@ -0,0 +1,39 @@
+# Generated by Django 3.1.14 on 2026-10-18 06:05
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_for(model, related_field):
+    return Coalesce(Subquery(
+        model.objects.filter(**{related_field: OuterRef('pk')})
+        .order_by().values(related_field)
+        .annotate(total=Count('pk')).values('total')), 0)
+
+
+def fill_counters(apps, schema_editor):
+    Recipe = apps.get_model('recipes', 'Recipe')
+    Favorite = apps.get_model('recipes', 'Favorite')
+    Follow = apps.get_model('recipes', 'Follow')
+    User = apps.get_model('users', 'User')
+    Recipe.objects.update(favorites_count=count_for(Favorite, 'recipes'))
+    User.objects.update(recipes_count=count_for(Recipe, 'author'),
+                        followers_count=count_for(Follow, 'author'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0003_auto_20220526_1634'),
+        ('users', '0003_auto_20261018_0605'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='favorites_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Количество добавлений в избранное'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 3.1.14 on 2026-10-18 06:40
+
+from django.db import migrations
+
+# A copy of the documents built by recipes.search as of this migration,
+# so that later changes to that module leave the migration as it was.
+POSTGRES_INDEX = """
+    UPDATE recipes_recipe SET search_vector =
+        setweight(to_tsvector('russian', recipes_recipe.name), 'A')
+        || setweight(to_tsvector('russian', coalesce((
+            SELECT string_agg(recipes_ingredient.name, ' ')
+            FROM recipes_recipeingredient
+            JOIN recipes_ingredient
+              ON recipes_ingredient.id = recipes_recipeingredient.ingredient_id
+            WHERE recipes_recipeingredient.recipe_id = recipes_recipe.id
+        ), '')), 'B')
+        || setweight(to_tsvector('russian', recipes_recipe.text), 'C')
+"""
+SQLITE_INDEX = """
+    INSERT INTO recipes_recipe_fts (rowid, name, ingredients, text)
+    SELECT recipes_recipe.id,
+        replace(replace(recipes_recipe.name, 'ё', 'е'), 'Ё', 'Е'),
+        replace(replace(coalesce((
+            SELECT group_concat(recipes_ingredient.name, ' ')
+            FROM recipes_recipeingredient
+            JOIN recipes_ingredient
+              ON recipes_ingredient.id = recipes_recipeingredient.ingredient_id
+            WHERE recipes_recipeingredient.recipe_id = recipes_recipe.id
+        ), ''), 'ё', 'е'), 'Ё', 'Е'),
+        replace(replace(recipes_recipe.text, 'ё', 'е'), 'Ё', 'Е')
+    FROM recipes_recipe
+"""
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute(
+            'ALTER TABLE recipes_recipe '
+            'ADD COLUMN IF NOT EXISTS search_vector tsvector')
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS recipe_search_vector_idx '
+            'ON recipes_recipe USING gin (search_vector)')
+        schema_editor.execute(POSTGRES_INDEX)
+    elif vendor == 'sqlite':
+        schema_editor.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS recipes_recipe_fts '
+            'USING fts5(name, ingredients, text, '
+            "tokenize = 'unicode61 remove_diacritics 2')")
+        schema_editor.execute('DELETE FROM recipes_recipe_fts')
+        schema_editor.execute(SQLITE_INDEX)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS recipe_search_vector_idx')
+        schema_editor.execute(
+            'ALTER TABLE recipes_recipe DROP COLUMN IF EXISTS search_vector')
+    elif vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS recipes_recipe_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0006_recipe_image_variants'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-18 07:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0009_shopping_lists'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='card',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='Карточка рецепта в JSON'),
+        ),
+    ]
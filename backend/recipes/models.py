@@ -36,15 +36,31 @@ class Recipe(models.Model):
     name = models.CharField('название рецепта', max_length=200)
     image = models.ImageField(verbose_name='Картинка',
                               blank=True, null=True)
+    image_variants = models.JSONField('Уменьшенные копии картинки',
+                                      default=dict, editable=False)
     text = models.TextField(verbose_name='Рецепт')
     ingredients = models.ManyToManyField(Ingredient,
                                          verbose_name='Ингредиенты',
                                          through='RecipeIngredient')
     cooking_time = models.PositiveIntegerField('Время приготовления')
+    favorites_count = models.PositiveIntegerField(
+        'Количество добавлений в избранное', default=0, editable=False)
+    popularity = models.FloatField('Популярность', default=0,
+                                   editable=False)
+    # Built by api.cards, empty until then.
+    card = models.TextField('Карточка рецепта в JSON', blank=True,
+                            default='', editable=False)
 
     class Meta:
+        ordering = ('-id',)
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
+        indexes = [
+            models.Index(fields=['author', '-id'],
+                         name='recipe_author_id_idx'),
+            models.Index(fields=['-popularity', '-id'],
+                         name='recipe_popularity_idx'),
+        ]
 
 
 class RecipeIngredient(models.Model):
@@ -75,11 +91,40 @@ class ShoppingCart(models.Model):
     recipes = models.ForeignKey(Recipe,
                                 on_delete=models.CASCADE,
                                 verbose_name='Рецепт в корзине')
+    created = models.DateTimeField('Дата добавления', auto_now_add=True)
 
     class Meta:
         verbose_name = 'Корзина'
         constraints = [models.UniqueConstraint(
             fields=['user', 'recipes'], name='UniqueConstraintShoppingCart')]
+        indexes = [
+            models.Index(fields=['recipes', 'user'],
+                         name='cart_recipe_user_idx'),
+        ]
+
+
+class ShoppingListItem(models.Model):
+    """
+    Ingredient totals of the recipes in a user's shopping cart, kept up to
+    date as the cart and its recipes change; see recipes.shopping.
+    """
+    user = models.ForeignKey(User,
+                             on_delete=models.CASCADE,
+                             related_name='shopping_list',
+                             verbose_name='Покупатель')
+    ingredient = models.ForeignKey(Ingredient,
+                                   on_delete=models.CASCADE,
+                                   related_name='shopping_list_items',
+                                   verbose_name='Ингредиент')
+    total = models.IntegerField('Количество', default=0)
+    recipes_count = models.IntegerField('Рецептов с ингредиентом', default=0)
+
+    class Meta:
+        verbose_name = 'Строка списка покупок'
+        verbose_name_plural = 'Списки покупок'
+        constraints = [models.UniqueConstraint(
+            fields=['user', 'ingredient'],
+            name='UniqueConstraintShoppingListItem')]
 
 
 class Favorite(models.Model):
@@ -89,11 +134,16 @@ class Favorite(models.Model):
     recipes = models.ForeignKey(Recipe,
                                 on_delete=models.CASCADE,
                                 verbose_name='рецепт в Избранном')
+    created = models.DateTimeField('Дата добавления', auto_now_add=True)
 
     class Meta:
         verbose_name = 'Избранное'
         constraints = [models.UniqueConstraint(
             fields=['user', 'recipes'], name='UniqueConstraintFavorite')]
+        indexes = [
+            models.Index(fields=['recipes', 'user'],
+                         name='favorite_recipe_user_idx'),
+        ]
 
 
 class Follow(models.Model):
@@ -114,3 +164,23 @@ class Follow(models.Model):
         verbose_name_plural = 'Подписки'
         constraints = [models.UniqueConstraint(
             fields=['user', 'author'], name='UniqueConstraintFollow')]
+
+
+class SimilarRecipe(models.Model):
+    recipe = models.ForeignKey(Recipe,
+                               on_delete=models.CASCADE,
+                               related_name='similar_recipes',
+                               verbose_name='Рецепт')
+    similar = models.ForeignKey(Recipe,
+                                on_delete=models.CASCADE,
+                                related_name='similar_to',
+                                verbose_name='Похожий рецепт')
+    score = models.FloatField('Сходство')
+
+    class Meta:
+        ordering = ('-score',)
+        verbose_name = 'Похожий рецепт'
+        verbose_name_plural = 'Похожие рецепты'
+        constraints = [models.UniqueConstraint(
+            fields=['recipe', 'similar'],
+            name='UniqueConstraintSimilarRecipe')]
@@ -0,0 +1,126 @@
+import re
+
+from django.db import connection
+from django.db.models import BooleanField, FloatField
+from django.db.models.expressions import RawSQL
+
+TERM = re.compile(r'\w+')
+MAX_TERMS = 8
+CHUNK = 500
+
+# Name, ingredient names and text, from the most to the least relevant.
+POSTGRES_INDEX = '''
+    UPDATE recipes_recipe SET search_vector =
+        setweight(to_tsvector('russian', recipes_recipe.name), 'A')
+        || setweight(to_tsvector('russian', coalesce((
+            SELECT string_agg(recipes_ingredient.name, ' ')
+            FROM recipes_recipeingredient
+            JOIN recipes_ingredient
+              ON recipes_ingredient.id = recipes_recipeingredient.ingredient_id
+            WHERE recipes_recipeingredient.recipe_id = recipes_recipe.id
+        ), '')), 'B')
+        || setweight(to_tsvector('russian', recipes_recipe.text), 'C')
+'''
+POSTGRES_MATCH = (
+    "recipes_recipe.search_vector @@ to_tsquery('russian', %s)")
+POSTGRES_RANK = (
+    "ts_rank(recipes_recipe.search_vector, to_tsquery('russian', %s))")
+
+
+def fold(sql):
+    # unicode61 only folds Latin diacritics, so ё is replaced by hand.
+    return f"replace(replace({sql}, 'ё', 'е'), 'Ё', 'Е')"
+
+
+# FTS5 has no Russian stemmer, terms are matched as prefixes instead.
+SQLITE_INDEX = '''
+    INSERT INTO recipes_recipe_fts (rowid, name, ingredients, text)
+    SELECT recipes_recipe.id, {name}, {ingredients}, {text}
+    FROM recipes_recipe
+'''.format(
+    name=fold('recipes_recipe.name'),
+    ingredients=fold('''coalesce((
+        SELECT group_concat(recipes_ingredient.name, ' ')
+        FROM recipes_recipeingredient
+        JOIN recipes_ingredient
+          ON recipes_ingredient.id = recipes_recipeingredient.ingredient_id
+        WHERE recipes_recipeingredient.recipe_id = recipes_recipe.id
+    ), '')'''),
+    text=fold('recipes_recipe.text'),
+)
+SQLITE_RANK = '-bm25(recipes_recipe_fts, 10.0, 4.0, 1.0)'
+
+
+def chunks(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), CHUNK):
+        yield ids[start:start + CHUNK]
+
+
+def index_recipes(recipe_ids):
+    """Rebuild the search document of the given recipes."""
+    with connection.cursor() as cursor:
+        for chunk in chunks(recipe_ids):
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    f'{POSTGRES_INDEX} WHERE recipes_recipe.id = ANY(%s)',
+                    [chunk])
+            elif connection.vendor == 'sqlite':
+                placeholders = ', '.join(['%s'] * len(chunk))
+                cursor.execute(f'DELETE FROM recipes_recipe_fts '
+                               f'WHERE rowid IN ({placeholders})', chunk)
+                cursor.execute(f'{SQLITE_INDEX} WHERE recipes_recipe.id '
+                               f'IN ({placeholders})', chunk)
+
+
+def unindex_recipes(recipe_ids):
+    # The Postgres document is a column and goes away with the row.
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for chunk in chunks(recipe_ids):
+            placeholders = ', '.join(['%s'] * len(chunk))
+            cursor.execute(f'DELETE FROM recipes_recipe_fts '
+                           f'WHERE rowid IN ({placeholders})', chunk)
+
+
+def rebuild_index():
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(POSTGRES_INDEX)
+        elif connection.vendor == 'sqlite':
+            cursor.execute('DELETE FROM recipes_recipe_fts')
+            cursor.execute(SQLITE_INDEX)
+
+
+def search_recipes(queryset, query):
+    """
+    Keep the recipes matching every word of the query, each as a prefix,
+    and annotate them with search_rank, higher being more relevant.
+    """
+    terms = TERM.findall(query.lower().replace('ё', 'е'))[:MAX_TERMS]
+    if not terms:
+        return queryset
+    if connection.vendor == 'postgresql':
+        tsquery = ' & '.join(f'{term}:*' for term in terms)
+        return queryset.annotate(
+            search_match=RawSQL(POSTGRES_MATCH, (tsquery,),
+                                output_field=BooleanField()),
+            search_rank=RawSQL(POSTGRES_RANK, (tsquery,),
+                               output_field=FloatField()),
+        ).filter(search_match=True)
+    if connection.vendor == 'sqlite':
+        match = ' '.join(f'"{term}"*' for term in terms)
+        # bm25() only works in the query that runs MATCH, so the virtual
+        # table is joined rather than used in a subquery per row.
+        return queryset.extra(
+            tables=['recipes_recipe_fts'],
+            where=['recipes_recipe_fts.rowid = recipes_recipe.id',
+                   'recipes_recipe_fts MATCH %s'],
+            params=[match],
+            select={'search_rank': SQLITE_RANK},
+        )
+    for term in terms:
+        queryset = queryset.filter(name__icontains=term)
+    return queryset.annotate(search_rank=RawSQL('0', (),
+                                                output_field=FloatField()))
@@ -0,0 +1,91 @@
+from collections import defaultdict
+
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+
+from .models import RecipeIngredient, ShoppingCart, ShoppingListItem
+
+CHUNK = 500
+
+# Postgres and SQLite share the upsert syntax.
+UPSERT = '''
+    INSERT INTO recipes_shoppinglistitem
+        (user_id, ingredient_id, total, recipes_count)
+    VALUES {values}
+    ON CONFLICT (user_id, ingredient_id) DO UPDATE SET
+        total = recipes_shoppinglistitem.total + excluded.total,
+        recipes_count = recipes_shoppinglistitem.recipes_count
+            + excluded.recipes_count
+'''
+
+
+def chunks(items):
+    items = list(items)
+    for start in range(0, len(items), CHUNK):
+        yield items[start:start + CHUNK]
+
+
+def shift_lists(user_ids, changes):
+    """
+    Apply changes {ingredient_id: (amount, recipes)} to the shopping lists
+    of the users with an upsert, so concurrent writers add up instead of
+    overwriting each other. Rows are written in key order to keep the
+    lock order stable; rows left with no recipe are removed.
+    """
+    if not changes:
+        return
+    rows = sorted((user_id, ingredient_id, amount, recipes)
+                  for user_id in set(user_ids)
+                  for ingredient_id, (amount, recipes) in changes.items())
+    with connection.cursor() as cursor:
+        for chunk in chunks(rows):
+            values = ', '.join(['(%s, %s, %s, %s)'] * len(chunk))
+            cursor.execute(UPSERT.format(values=values),
+                           [value for row in chunk for value in row])
+    if any(recipes < 0 for _, recipes in changes.values()):
+        for chunk in chunks(user_ids):
+            ShoppingListItem.objects.filter(
+                user_id__in=chunk, ingredient_id__in=changes,
+                recipes_count__lte=0).delete()
+
+
+def shift_recipes(user_ids, recipe_ids, sign):
+    """Add (sign=1) or remove (sign=-1) recipes from the users' lists."""
+    changes = defaultdict(lambda: [0, 0])
+    for ingredient_id, amount in RecipeIngredient.objects.filter(
+            recipe_id__in=recipe_ids).values_list('ingredient_id', 'amount'):
+        changes[ingredient_id][0] += sign * amount
+        changes[ingredient_id][1] += sign
+    shift_lists(user_ids, changes)
+
+
+def cart_users(recipe_id):
+    return list(ShoppingCart.objects.filter(recipes_id=recipe_id)
+                .values_list('user_id', flat=True))
+
+
+def aggregate_lists(user_ids=None):
+    """
+    Shopping lists computed from the carts, as (user_id, ingredient_id,
+    total, recipes_count) rows ordered by user and ingredient.
+    """
+    rows = ShoppingCart.objects.all()
+    if user_ids is not None:
+        rows = rows.filter(user_id__in=user_ids)
+    return (rows.filter(recipes__recipe_ingredient__isnull=False)
+            .values_list('user_id', 'recipes__recipe_ingredient__ingredient')
+            .annotate(total=Sum('recipes__recipe_ingredient__amount'),
+                      recipes_count=Count('id'))
+            .order_by('user_id', 'recipes__recipe_ingredient__ingredient'))
+
+
+@transaction.atomic
+def rebuild_lists(user_ids):
+    """Recompute the shopping lists of the users from their carts."""
+    for chunk in chunks(user_ids):
+        ShoppingListItem.objects.filter(user_id__in=chunk).delete()
+        ShoppingListItem.objects.bulk_create(
+            ShoppingListItem(user_id=user_id, ingredient_id=ingredient_id,
+                             total=total, recipes_count=recipes_count)
+            for user_id, ingredient_id, total, recipes_count
+            in aggregate_lists(chunk))
@@ -0,0 +1,148 @@
+import io
+import json
+import os
+import tempfile
+
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.test import TestCase
+from users.models import User
+
+from .models import (Ingredient, Recipe, RecipeIngredient, ShoppingCart,
+                     ShoppingListItem)
+from .shopping import aggregate_lists, rebuild_lists
+
+
+class ShoppingListAdminTest(TestCase):
+    """Admin edits and deletes keep the materialised shopping lists in step."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(
+            email='admin@example.com', username='admin', first_name='Имя',
+            last_name='Фамилия', password='pass12345QQ')
+        cls.buyer = User.objects.create_user(
+            email='buyer@example.com', username='buyer', first_name='Имя',
+            last_name='Фамилия', password='pass12345QQ')
+        cls.ingredients = [
+            Ingredient.objects.create(name=f'продукт {index}',
+                                      measurement_unit='г')
+            for index in range(3)]
+        cls.recipes = [
+            Recipe.objects.create(author=cls.admin, name=f'рецепт {index}',
+                                  text='текст', cooking_time=5)
+            for index in range(2)]
+        for recipe in cls.recipes:
+            for ingredient in cls.ingredients[:2]:
+                RecipeIngredient.objects.create(
+                    recipe=recipe, ingredient=ingredient, amount=10)
+            ShoppingCart.objects.create(user=cls.buyer, recipes=recipe)
+        rebuild_lists([cls.buyer.id])
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def assert_list_is_current(self):
+        self.assertEqual(
+            sorted(ShoppingListItem.objects.values_list(
+                'user_id', 'ingredient_id', 'total', 'recipes_count')),
+            list(aggregate_lists()))
+
+    def change(self, row, **fields):
+        data = {'recipe': row.recipe_id, 'ingredient': row.ingredient_id,
+                'amount': row.amount, **fields}
+        response = self.client.post(
+            f'/admin/recipes/recipeingredient/{row.id}/change/', data)
+        self.assertEqual(response.status_code, 302)
+
+    def test_amount_and_ingredient_changes(self):
+        row = RecipeIngredient.objects.first()
+        self.change(row, amount=25)
+        self.assert_list_is_current()
+        row.refresh_from_db()
+        self.change(row, ingredient=self.ingredients[2].id)
+        self.assert_list_is_current()
+        self.assertTrue(ShoppingListItem.objects.filter(
+            ingredient=self.ingredients[2], total=25).exists())
+
+    def test_ingredient_deleted(self):
+        row = RecipeIngredient.objects.first()
+        self.client.post(
+            f'/admin/recipes/recipeingredient/{row.id}/delete/',
+            {'post': 'yes'})
+        self.assert_list_is_current()
+        self.client.post('/admin/recipes/recipeingredient/', {
+            'action': 'delete_selected', 'post': 'yes',
+            '_selected_action': list(RecipeIngredient.objects.filter(
+                recipe=self.recipes[1]).values_list('id', flat=True))})
+        self.assert_list_is_current()
+
+    def test_recipe_and_cart_deleted(self):
+        self.client.post(
+            f'/admin/recipes/recipe/{self.recipes[0].id}/delete/',
+            {'post': 'yes'})
+        self.assert_list_is_current()
+        cart = ShoppingCart.objects.get()
+        self.client.post(
+            f'/admin/recipes/shoppingcart/{cart.id}/delete/',
+            {'post': 'yes'})
+        self.assertFalse(ShoppingListItem.objects.exists())
+
+    def test_author_deleted(self):
+        author = User.objects.create_user(
+            email='author@example.com', username='author', first_name='Имя',
+            last_name='Фамилия', password='pass12345QQ')
+        recipe = Recipe.objects.create(author=author, name='рецепт',
+                                       text='текст', cooking_time=5)
+        for ingredient in self.ingredients[1:]:
+            RecipeIngredient.objects.create(
+                recipe=recipe, ingredient=ingredient, amount=7)
+        ShoppingCart.objects.create(user=self.buyer, recipes=recipe)
+        rebuild_lists([self.buyer.id])
+        author.delete()
+        self.assert_list_is_current()
+        self.assertFalse(ShoppingListItem.objects.filter(
+            ingredient=self.ingredients[2]).exists())
+        Recipe.objects.get(id=self.recipes[0].id).delete()
+        self.assert_list_is_current()
+
+
+class LoadDataTest(TestCase):
+
+    def load(self, *ingredients):
+        descriptor, path = tempfile.mkstemp(suffix='.json')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as f:
+            json.dump([{'name': name, 'measurement_unit': 'г'}
+                       for name in ingredients], f)
+        call_command('load_data', path=path, stdout=io.StringIO())
+
+    def names(self, prefix):
+        response = self.client.get(f'/api/ingredients/?name={prefix}')
+        return [row['name'] for row in response.json()]
+
+    def test_loaded_ingredients_reach_cached_responses(self):
+        cache.clear()
+        self.load('мука')
+        self.assertEqual(self.names('му'), ['мука'])
+        self.load('мускат', 'мука')
+        self.assertEqual(self.names('му'), ['мука', 'мускат'])
+        self.assertEqual(Ingredient.objects.count(), 2)
+
+
+class QueryPlanTest(TestCase):
+    """The hot queries are served from indexes, as check_query_plans sees."""
+
+    @classmethod
+    def setUpTestData(cls):
+        Ingredient.objects.bulk_create(
+            Ingredient(name=f'продукт {index}', measurement_unit='г')
+            for index in range(100))
+
+    def test_no_full_scans(self):
+        out = io.StringIO()
+        try:
+            call_command('check_query_plans', users=100, recipes=2000,
+                         stdout=out)
+        except CommandError as error:
+            self.fail(f'{error}\n{out.getvalue()}')
@@ -6,6 +6,10 @@ class User(AbstractUser):
     email = models.EmailField(unique=True)
     first_name = models.CharField(max_length=100)
     last_name = models.CharField(max_length=100)
+    recipes_count = models.PositiveIntegerField(
+        'Количество рецептов', default=0, editable=False)
+    followers_count = models.PositiveIntegerField(
+        'Количество подписчиков', default=0, editable=False)
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username', 'first_name', 'last_name']